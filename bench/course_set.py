@@ -0,0 +1,103 @@
+import argparse
+import datetime
+import json
+import sys
+import time
+import tracemalloc
+from dataclasses import dataclass
+
+from provider.source.base import Course, WeeklyRecurrence
+
+
+@dataclass
+class LegacyWeeklyRecurrence:
+    # The mutable model Course replaced, kept to compare against
+    interval: int
+    count: int
+
+    def __hash__(self):
+        return self.interval * 31 + self.count
+
+
+@dataclass
+class LegacyCourse:
+    name: str
+    location: str
+    recurrence: LegacyWeeklyRecurrence
+    start_date: datetime.datetime
+    end_date: datetime.datetime
+
+    def __hash__(self):
+        h = hash(self.name) * 31
+        h += hash(self.location) * 31
+        h += hash(self.recurrence) * 31
+        h += hash(self.start_date) * 31
+        h += hash(self.end_date) * 31
+        return h
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and \
+            self.name == other.name and self.location == other.location and \
+            self.recurrence == other.recurrence and self.start_date == other.start_date \
+            and self.end_date == other.end_date
+
+
+def make_courses(course_class, recurrence_class, count: int, offset: int = 0) -> list:
+    first_day = datetime.datetime(2024, 9, 2, 8)
+    courses = []
+    for i in range(offset, offset + count):
+        start = first_day + datetime.timedelta(days=i % 7, minutes=55 * (i % 11))
+        courses.append(course_class(name=f'Course {i % 997}', location=f'Room {i % 131}',
+                                    recurrence=recurrence_class(1 + i % 2, 1 + i % 16),
+                                    start_date=start, end_date=start + datetime.timedelta(minutes=45 + i // 1000)))
+    return courses
+
+
+def measure(course_class, recurrence_class, count: int, changed: int) -> dict:
+    tracemalloc.start()
+    old = make_courses(course_class, recurrence_class, count)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    new = old[changed:] + make_courses(course_class, recurrence_class, changed, offset=count)
+
+    start = time.perf_counter()
+    old_set, new_set = set(old), set(new)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    addition = new_set - old_set
+    removal = old_set - new_set
+    diff = time.perf_counter() - start
+    assert len(addition) == len(removal) == changed
+
+    return {
+        'model': course_class.__name__,
+        'courses': count,
+        'changed': changed,
+        'memory_bytes': memory,
+        'bytes_per_course': memory / count,
+        'set_build_s': build,
+        'set_diff_s': diff,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Set-diff time and memory of the course model')
+    parser.add_argument('--courses', type=int, default=100_000)
+    parser.add_argument('--changed', type=int, default=1_000)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    results = [measure(LegacyCourse, LegacyWeeklyRecurrence, args.courses, args.changed),
+               measure(Course, WeeklyRecurrence, args.courses, args.changed)]
+
+    report = json.dumps({'python': sys.version, 'timestamp': time.time(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,460 @@
+import base64
+import datetime
+import email.parser
+import gzip
+import io
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+from zoneinfo import ZoneInfo
+
+# Local stand-ins for jwxt and the Calendar v3 API, good enough for the providers to run against them unchanged
+
+first_school_day = datetime.datetime(2024, 9, 2)
+time_zone = 'Asia/Shanghai'
+weekdays = ['星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日']
+
+_login_page = '''<html><body><form id="pwdFromId" method="post" action="/authserver/login?type=userNameLogin">
+<input id="username" name="username" value="">{password}
+<input id="captcha" name="captcha" value=""><img id="captchaImg" src="/authserver/getCaptcha.htl?{nonce}">
+<input type="hidden" name="execution" value="e1s1"><input type="hidden" name="_eventId" value="submit">
+<button id="login_submit" type="submit">Login</button></form>{tip}</body></html>'''
+# Like the real authserver, whose encrypt.js fills saltPassword, or a plain password field without the salt
+_salted_password = '''<input id="password" type="password"><input type="hidden" id="saltPassword" name="password">
+<input type="hidden" id="pwdEncryptSalt" value="{salt}">'''
+_plain_password = '<input id="password" type="password" name="password">'
+
+
+class _FakeServer:
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.stats = {}
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.reset_stats()
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.__server.server_port}'
+
+    def reset_stats(self):
+        with self.__lock:
+            self.stats = {'requests': 0, 'sub_requests': 0, 'bytes_in': 0, 'bytes_out': 0}
+
+    def count(self, name: str, value: int = 1):
+        with self.__lock:
+            self.stats[name] += value
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body are written separately, Nagle would hold the body back for a delayed ACK
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def handle_one(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                server.count('requests')
+                server.count('bytes_in', len(body))
+                if server.latency:
+                    time.sleep(server.latency)
+
+                status, headers, content = server.handle(self, body)
+                if content and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    content = gzip.compress(content, 1)
+                    headers = [*headers, ('Content-Encoding', 'gzip')]
+                server.count('bytes_out', len(content))
+
+                self.send_response(status)
+                for name, value in headers:
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = handle_one
+
+        self.__server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def handle(self, handler: BaseHTTPRequestHandler, body: bytes) -> tuple[int, list, bytes]:
+        raise NotImplementedError()
+
+
+class FakeNUISTServer(_FakeServer):
+    # Authserver and jwxt on one host: the CAS login with its captcha, the tyrzBtn redirect and the cxxszhxqkb.do
+    # timetable. The stand-in cannot tell a misread captcha, it rejects the first captcha_rejections answers instead
+    # and keeps every answer in captchas.
+    def __init__(self, courses: int = 40, latency: float = 0, username: str = 'student', password: str = 'secret',
+                 salt: str = 'rjBFAaHsNkKvuWOH', captcha_rejections: int = 0):
+        super().__init__(latency)
+        self.username = username
+        self.password = password
+        self.salt = salt
+        self.captcha_rejections = captcha_rejections
+        self.captchas = []
+        self.session_id = 'jw'
+        self.__sessions = itertools.count(1)
+        self.rows = [self.make_row(i) for i in range(courses)]
+
+    def expire_sessions(self):
+        # jwxt sessions handed out so far are turned away from now on
+        self.session_id = f'jw{next(self.__sessions)}'
+
+    def login_page(self, tip: str = '') -> bytes:
+        password = _salted_password.format(salt=self.salt) if self.salt else _plain_password
+        return _login_page.format(password=password, nonce=random.random(), tip=tip).encode()
+
+    @staticmethod
+    def captcha_image() -> bytes:
+        from PIL import Image, ImageDraw, ImageFont
+
+        image = Image.new('RGB', (100, 40), 'white')
+        text = ''.join(random.choice('abcdefhkmnprstwxyz2345678') for _ in range(4))
+        ImageDraw.Draw(image).text((10, 4), text, fill='black', font=ImageFont.load_default(28))
+        buffer = io.BytesIO()
+        image.save(buffer, 'PNG')
+        return buffer.getvalue()
+
+    def decrypt_password(self, encrypted: str) -> str:
+        # Reverse of encryptPassword(): AES-CBC with the salt as key, 64 random chars in front of the password. The IV
+        # only garbles the first block, which belongs to the random chars.
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
+        try:
+            decryptor = Cipher(algorithms.AES(self.salt.encode()), modes.CBC(bytes(16))).decryptor()
+            data = decryptor.update(base64.b64decode(encrypted)) + decryptor.finalize()
+            unpadder = padding.PKCS7(128).unpadder()
+            return (unpadder.update(data) + unpadder.finalize())[64:].decode()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def make_row(i: int) -> dict:
+        start = 1 + 2 * (i % 5)
+        if i % 3 == 0:
+            weeks = f'{1 + i % 4}-{16 + i % 3}周'
+        elif i % 3 == 1:
+            weeks = f'1-{15 + i % 2 * 2}周({'单' if i % 2 else '双'})'
+        else:
+            weeks = '1,2,3,5,7,11周'
+        return {'KCM': f'Course {i}', 'KCH': f'{i:08d}', 'JASMC': f'Room {i % 37}', 'SKJS': f'Teacher {i % 23}',
+                'ZCMC': weeks, 'SKXQ_DISPLAY': weekdays[i % 5], 'KSJC_DISPLAY': f'第{start}节',
+                'JSJC_DISPLAY': f'第{start + 1}节', 'XNXQDM': '2024-2025-1', 'KBBZ': None}
+
+    def handle(self, handler, body):
+        request = urlparse(handler.path)
+        query = parse_qs(request.query)
+        form = parse_qs(body.decode())
+        cookies = dict(c.strip().split('=', 1) for c in handler.headers.get('Cookie', '').split(';') if '=' in c)
+        signed_in = cookies.get('JSESSIONID') == self.session_id
+        html = [('Content-Type', 'text/html; charset=utf-8')]
+
+        match handler.command, request.path:
+            case 'GET', '/authserver/login':
+                if 'service' in query and cookies.get('CASTGC') == 'tgt':
+                    service = query['service'][0]
+                    return 302, [('Location', f'{service}{'&' if '?' in service else '?'}ticket=ST-1')], b''
+                return 200, html, self.login_page()
+            case 'GET', '/authserver/getCaptcha.htl':
+                return 200, [('Content-Type', 'image/png')], self.captcha_image()
+            case 'POST', '/authserver/login':
+                answer = form.get('captcha', [''])[0]
+                self.captchas.append(answer)
+                if not answer or self.captcha_rejections > 0:
+                    self.captcha_rejections = max(0, self.captcha_rejections - 1)
+                    return 200, html, self.login_page('<span id="showErrorTip">验证码错误</span>')
+                password = form.get('password', [''])[0]
+                if self.salt:
+                    password = self.decrypt_password(password)
+                if form.get('username') == [self.username] and password == self.password:
+                    return 302, [('Location', '/authserver/index.do'), ('Set-Cookie', 'CASTGC=tgt; Path=/authserver')], b''
+                tip = '<span id="showErrorTip" title="您提供的用户名或者密码有误"></span>'
+                return 200, html, self.login_page(tip)
+            case 'GET', '/jwapp/sys/yjsrzfwapp/dbLogin/main.do':
+                target = f'/authserver/login?service=http://{handler.headers['Host']}/jwapp/sys/emaphome/portal/index.do'
+                return 200, html, f'<a id="tyrzBtn" href="{target}">Login</a>'.encode()
+            case 'GET', '/jwapp/sys/emaphome/portal/index.do':
+                if 'ticket' in query:
+                    return 302, [('Location', '/jwapp/sys/emaphome/portal/index.do'),
+                                 ('Set-Cookie', f'JSESSIONID={self.session_id}; Path=/')], b''
+                return 200, html, b'portal'
+            case 'GET', '/jwapp/sys/wdkb/*default/index.do':
+                if not signed_in:
+                    return 302, [('Location', '/authserver/login')], b''
+                return 200, html, b'wdkb'
+            case 'POST', '/jwapp/sys/wdkb/modules/xskcb/cxxszhxqkb.do':
+                if not signed_in:
+                    return 302, [('Location', '/authserver/login')], b''
+                rows = [dict(row, XNXQDM=form.get('XNXQDM', [''])[0]) for row in self.rows]
+                content = json.dumps({'datas': {'cxxszhxqkb': {'totalSize': len(rows), 'rows': rows}}, 'code': '0'})
+                return 200, [('Content-Type', 'application/json;charset=UTF-8')], content.encode()
+        return 404, html, b'Not found'
+
+
+def _split_fields(fields: str) -> dict[str, str]:
+    # "a,b,items(c,d)" -> {'a': None, 'b': None, 'items': 'c,d'}
+    result = {}
+    depth = 0
+    start = 0
+    for i, char in enumerate(fields + ','):
+        if char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+        elif char == ',' and depth == 0:
+            part = fields[start:i].strip()
+            if '(' in part:
+                result[part[:part.index('(')]] = part[part.index('(') + 1:-1]
+            elif part:
+                result[part.split('/')[0]] = None
+            start = i + 1
+    return result
+
+
+def _project(value, fields: str):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [_project(item, fields) for item in value]
+    selected = _split_fields(fields)
+    return {key: _project(item, selected[key]) for key, item in value.items() if key in selected}
+
+
+class _HttpError(Exception):
+    def __init__(self, status: int, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+
+
+class FakeCalendarServer(_FakeServer):
+    # Calendar v3 calendars.get, events list/insert/patch/delete and the batch endpoint over one in-memory calendar
+    def __init__(self, events: int = 10_000, latency: float = 0, calendar_id: str = 'primary'):
+        super().__init__(latency)
+        self.calendar_id = calendar_id
+        self.__lock = threading.Lock()
+        self.__ids = itertools.count()
+        self.__version = 0
+        self.__events: dict[str, dict] = {}
+        for i in range(events):
+            start = first_school_day + datetime.timedelta(days=i % 5, minutes=8 * 60 + 55 * (i % 11))
+            self.add_event({
+                'summary': f'Course {i}',
+                'location': f'Room {i % 131}',
+                'start': {'dateTime': start.isoformat(), 'timeZone': time_zone},
+                'end': {'dateTime': (start + datetime.timedelta(minutes=95)).isoformat(), 'timeZone': time_zone},
+                'recurrence': [f'RRULE:FREQ=WEEKLY;WKST=SU;COUNT={1 + i % 16};INTERVAL={1 + i % 2}'],
+            })
+
+    @property
+    def events(self) -> list[dict]:
+        with self.__lock:
+            return [event for event in self.__events.values() if event['status'] != 'cancelled']
+
+    def add_event(self, body: dict) -> dict:
+        with self.__lock:
+            event_id = body.get('id') or f'ev{next(self.__ids):08d}'
+            # Client IDs are base32hex, and stay taken after the event was deleted
+            if not re.fullmatch(r'[0-9a-v]{5,1024}', event_id):
+                raise _HttpError(400, 'invalid')
+            if event_id in self.__events:
+                raise _HttpError(409, 'duplicate')
+            now = datetime.datetime.now(datetime.UTC).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+            # The bulk of what a real event carries besides the fields the providers read
+            event = {
+                'kind': 'calendar#event',
+                'id': event_id,
+                'status': 'confirmed',
+                'htmlLink': f'https://www.google.com/calendar/event?eid={event_id}',
+                'created': now,
+                'updated': now,
+                'summary': body.get('summary'),
+                'creator': {'email': 'student@example.com', 'self': True},
+                'organizer': {'email': 'student@example.com', 'self': True},
+                'iCalUID': f'{event_id}@google.com',
+                'sequence': 0,
+                'reminders': {'useDefault': True},
+                'eventType': 'default',
+            }
+            self.__apply(event, body)
+            self.__events[event_id] = event
+            return event
+
+    def __apply(self, event: dict, body: dict):
+        for key, value in body.items():
+            if key in ('start', 'end'):
+                value = dict(value)
+                tz = ZoneInfo(value.get('timeZone', time_zone))
+                date = datetime.datetime.fromisoformat(value['dateTime'])
+                value['dateTime'] = (date if date.tzinfo else date.replace(tzinfo=tz)).isoformat()
+            if value is None:
+                event.pop(key, None)
+            elif key not in ('id', 'etag', 'kind', 'status'):
+                event[key] = value
+        self.__version += 1
+        event['_version'] = self.__version
+        event['etag'] = f'"{3000000000000000 + self.__version}"'
+
+    def __get(self, event_id: str) -> dict:
+        event = self.__events.get(event_id)
+        if event is None:
+            raise _HttpError(404, 'notFound')
+        if event['status'] == 'cancelled':
+            raise _HttpError(410, 'deleted')
+        return event
+
+    @staticmethod
+    def __span(event: dict) -> tuple[datetime.datetime, datetime.datetime]:
+        start = datetime.datetime.fromisoformat(event['start']['dateTime'])
+        end = datetime.datetime.fromisoformat(event['end']['dateTime'])
+        for rule in event.get('recurrence', []):
+            count = re.search(r'COUNT=(\d+)', rule)
+            interval = re.search(r'INTERVAL=(\d+)', rule)
+            if count:
+                end += datetime.timedelta(weeks=(int(count[1]) - 1) * (int(interval[1]) if interval else 1))
+        return start, end
+
+    def __list(self, query: dict) -> dict:
+        max_results = min(int(query.get('maxResults', 250)), 2500)
+        offset = int(query.get('pageToken', 0))
+        with self.__lock:
+            if 'syncToken' in query:
+                if 'timeMin' in query or 'timeMax' in query:
+                    raise _HttpError(400, 'invalid')
+                since = int(query['syncToken'])
+                if since > self.__version:
+                    raise _HttpError(410, 'fullSyncRequired')
+                events = [e for e in self.__events.values() if e['_version'] > since]
+            else:
+                show_deleted = query.get('showDeleted') == 'true'
+                events = [e for e in self.__events.values() if show_deleted or e['status'] != 'cancelled']
+                time_min = datetime.datetime.fromisoformat(query['timeMin']) if 'timeMin' in query else None
+                time_max = datetime.datetime.fromisoformat(query['timeMax']) if 'timeMax' in query else None
+                if time_min or time_max:
+                    spans = [(e, self.__span(e)) if 'start' in e else (e, None) for e in events]
+                    events = [e for e, span in spans if span is None or
+                              ((time_min is None or span[1] > time_min) and (time_max is None or span[0] < time_max))]
+            version = self.__version
+
+        page = {
+            'kind': 'calendar#events',
+            'etag': f'"p{version}"',
+            'summary': 'student@example.com',
+            'updated': datetime.datetime.now(datetime.UTC).isoformat(),
+            'timeZone': time_zone,
+            'accessRole': 'owner',
+            'defaultReminders': [{'method': 'popup', 'minutes': 10}],
+            'items': [{key: value for key, value in e.items() if key != '_version'}
+                      for e in events[offset:offset + max_results]],
+        }
+        if offset + max_results < len(events):
+            page['nextPageToken'] = str(offset + max_results)
+        else:
+            page['nextSyncToken'] = str(version)
+        return page
+
+    def call(self, method: str, path: str, query: dict, body: dict) -> tuple[int, dict]:
+        prefix = f'/calendar/v3/calendars/{self.calendar_id}'
+        path = unquote(path)
+        try:
+            if not path.startswith(prefix):
+                raise _HttpError(404, 'notFound')
+            rest = path[len(prefix):].strip('/').split('/')
+            match method, rest:
+                case 'GET', ['']:
+                    result = {'kind': 'calendar#calendar', 'id': self.calendar_id, 'timeZone': time_zone}
+                case 'GET', ['events']:
+                    result = self.__list(query)
+                case 'POST', ['events']:
+                    result = self.add_event(body)
+                case 'GET', ['events', event_id]:
+                    with self.__lock:
+                        if event_id not in self.__events:
+                            raise _HttpError(404, 'notFound')
+                        result = self.__events[event_id]
+                case 'PUT', ['events', event_id]:
+                    with self.__lock:
+                        if event_id not in self.__events:
+                            raise _HttpError(404, 'notFound')
+                        event = self.__events[event_id]
+                        # An update with status confirmed brings a deleted event back
+                        if body.get('status') == 'confirmed':
+                            event['status'] = 'confirmed'
+                        for key in ('location', 'recurrence'):
+                            event.pop(key, None)
+                        self.__apply(event, body)
+                    result = event
+                case 'PATCH', ['events', event_id]:
+                    with self.__lock:
+                        event = self.__get(event_id)
+                        self.__apply(event, body)
+                    result = event
+                case 'DELETE', ['events', event_id]:
+                    with self.__lock:
+                        event = self.__get(event_id)
+                        event['status'] = 'cancelled'
+                        self.__apply(event, {})
+                    return 204, None
+                case _:
+                    raise _HttpError(404, 'notFound')
+        except _HttpError as e:
+            return e.status, {'error': {'code': e.status, 'message': e.reason,
+                                        'errors': [{'domain': 'global', 'reason': e.reason}]}}
+
+        result = {key: value for key, value in result.items() if key != '_version'}
+        return 200, _project(result, query.get('fields'))
+
+    def handle(self, handler, body):
+        request = urlparse(handler.path)
+        if request.path == '/batch/calendar/v3':
+            content_type = handler.headers['Content-Type']
+            return 200, [('Content-Type', 'multipart/mixed; boundary=batch_fake')], self.__batch(content_type, body)
+
+        query = {key: values[0] for key, values in parse_qs(request.query).items()}
+        status, result = self.call(handler.command, request.path, query, json.loads(body) if body else {})
+        return status, [('Content-Type', 'application/json; charset=UTF-8')], \
+            json.dumps(result).encode() if result is not None else b''
+
+    def __batch(self, content_type: str, body: bytes) -> bytes:
+        message = email.parser.BytesParser().parsebytes(f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+        parts = []
+        for part in message.get_payload():
+            self.count('sub_requests')
+            head, _, payload = part.get_payload().replace('\r\n', '\n').partition('\n\n')
+            method, target, _ = head.split('\n', 1)[0].split(' ', 2)
+            request = urlparse(target)
+            query = {key: values[0] for key, values in parse_qs(request.query).items()}
+            status, result = self.call(method, request.path, query, json.loads(payload) if payload.strip() else {})
+
+            content = json.dumps(result) if result is not None else ''
+            # Long Content-IDs arrive folded over two lines
+            content_id = ' '.join(part['Content-ID'].split()).strip('<>')
+            parts.append(f'--batch_fake\r\nContent-Type: application/http\r\n'
+                         f'Content-ID: <response-{content_id}>\r\n\r\n'
+                         f'HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n'
+                         f'Content-Type: application/json; charset=UTF-8\r\nContent-Length: {len(content)}\r\n\r\n'
+                         f'{content}\r\n')
+        return (''.join(parts) + '--batch_fake--\r\n').encode()
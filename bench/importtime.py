@@ -0,0 +1,64 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Modules a script imports to run a sync, each measured in a fresh interpreter
+entry_points = [
+    'cache',
+    'sync',
+    'provider.source.nuist',
+    'provider.source.google',
+    'provider.destination.google',
+]
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module: str) -> dict:
+    # python -X importtime writes "import time: self [us] | cumulative | imported package" lines to stderr
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                             cwd=root, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+
+    imports = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        imports[name.strip()] = int(cumulative)
+
+    slowest = sorted(((name, us) for name, us in imports.items() if name != module), key=lambda i: -i[1])[:10]
+    return {
+        'module': module,
+        'cumulative_us': imports[module],
+        'process_wall_s': wall,
+        'imported_modules': len(imports),
+        'slowest': [{'module': name, 'cumulative_us': us} for name, us in slowest],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record python -X importtime figures for every entry point')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per entry point, the fastest one is kept')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for module in entry_points:
+        runs = [measure(module) for _ in range(args.repeat)]
+        results.append(min(runs, key=lambda r: r['cumulative_us']))
+
+    report = json.dumps({'python': sys.version, 'timestamp': time.time(), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import sys
+import tempfile
+
+import cache
+from bench.fake_servers import FakeNUISTServer, first_school_day
+from provider.source import _nuist
+from provider.source._browser_pool import BrowserPool
+from provider.source.nuist import NUISTSourceProvider
+
+# Logs in to the local stand-in authserver through both login engines, captcha, retry and password encryption
+# included, and checks that the jwxt session cookies come back
+
+
+def check_cookies(cookies: list[dict], server: FakeNUISTServer):
+    names = {cookie['name']: cookie['value'] for cookie in cookies}
+    assert names.get('JSESSIONID') == server.session_id, f'No jwxt session among {sorted(names)}'
+    assert names.get('CASTGC') == 'tgt', f'No CAS ticket among {sorted(names)}'
+
+
+def check_http():
+    with FakeNUISTServer(captcha_rejections=1) as server:
+        cookies = _nuist.login_with_http(server.username, server.password, server.url, server.url)
+        check_cookies(cookies, server)
+        # One rejected captcha, then a fresh form and image
+        assert len(server.captchas) == 2, server.captchas
+        assert all(server.captchas), server.captchas
+
+
+def check_wrong_password():
+    # Turned down once, without a second submission through the browser
+    with FakeNUISTServer() as server, tempfile.TemporaryDirectory() as directory:
+        cache.cache_dir = directory
+        provider = NUISTSourceProvider(server.username, 'wrong', first_school_day, '2024-2025-1',
+                                       authserver_url=server.url, jwxt_url=server.url)
+        try:
+            provider.get_courses()
+        except _nuist.CredentialsError:
+            pass
+        else:
+            raise AssertionError('A wrong password was accepted')
+        assert len(server.captchas) == 1, server.captchas
+
+
+def check_browser(headless: bool):
+    # The stand-in has no encrypt.js, so the browser gets the plain password field
+    pool = BrowserPool(size=1, headless=headless)
+    try:
+        with FakeNUISTServer(salt=None, captcha_rejections=1) as server:
+            cookies = _nuist.login_with_browser(server.username, server.password, headless, server.url, server.url,
+                                                pool=pool)
+            check_cookies(cookies, server)
+            assert len(server.captchas) == 2, server.captchas
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check both NUIST login engines against the local stand-in server')
+    parser.add_argument('--check', choices=['http', 'wrong_password', 'browser'], action='append',
+                        help='only run these checks')
+    parser.add_argument('--headed', action='store_true', help='show the browser window')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    checks = {'http': check_http, 'wrong_password': check_wrong_password,
+              'browser': lambda: check_browser(not args.headed)}
+    failed = False
+    for name, check in checks.items():
+        if args.check is not None and name not in args.check:
+            continue
+        try:
+            check()
+            print(f'{name}: ok', file=sys.stderr)
+        except Exception as e:
+            failed = True
+            print(f'{name}: failed, {type(e).__name__}: {e}', file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
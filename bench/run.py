@@ -0,0 +1,190 @@
+import argparse
+import dataclasses
+import datetime
+import json
+import logging
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cache
+import planner
+from metrics import default_metrics
+from bench.fake_servers import FakeNUISTServer, FakeCalendarServer, first_school_day
+from provider._event_store import EventStore
+from provider._google import RequestExecutor
+from provider.destination.google import GoogleDestinationProvider
+from provider.source import _nuist
+from provider.source.google import GoogleSourceProvider
+from provider.source.nuist import NUISTSourceProvider
+
+# Scenario benchmarks of a sync against the local stand-in servers, nothing leaves the machine
+
+
+def summarize(name: str, durations: list[float], items: int, peak_memory: int, server_stats: dict) -> dict:
+    durations = sorted(durations)
+    return {
+        'scenario': name,
+        'iterations': len(durations),
+        'items_per_iteration': items,
+        'throughput_per_s': items * len(durations) / sum(durations),
+        'p50_s': statistics.median(durations),
+        'p95_s': durations[min(len(durations) - 1, round(0.95 * (len(durations) - 1)))],
+        'peak_memory_bytes': peak_memory,
+        'server': server_stats,
+    }
+
+
+def measure(name: str, iteration, iterations: int, servers: list, setup=None) -> dict:
+    # Timed runs first, then one more under tracemalloc for the peak, which would otherwise skew the timings
+    durations = []
+    items = 0
+    for server in servers:
+        server.reset_stats()
+    default_metrics.reset()
+    for _ in range(iterations):
+        state = setup() if setup else None
+        start = time.perf_counter()
+        items = iteration(state) if setup else iteration()
+        durations.append(time.perf_counter() - start)
+    stats = {type(server).__name__: {key: value / iterations for key, value in server.stats.items()}
+             for server in servers}
+    spans = default_metrics.snapshot()
+
+    state = setup() if setup else None
+    tracemalloc.start()
+    iteration(state) if setup else iteration()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = summarize(name, durations, items, peak, stats)
+    result['metrics'] = {'spans': spans['spans'], 'counters': spans['counters']}
+    print(f'{name}: p50 {result['p50_s'] * 1000:.1f}ms, p95 {result['p95_s'] * 1000:.1f}ms, '
+          f'{result['throughput_per_s']:.0f} items/s', file=sys.stderr)
+    return result
+
+
+def google_source(calendar: FakeCalendarServer, executor: RequestExecutor, **kwargs) -> GoogleSourceProvider:
+    return GoogleSourceProvider(first_school_day, api_key='bench', executor=executor, cache_responses=False,
+                                api_endpoint=f'{calendar.url}/', **kwargs)
+
+
+def edited(courses: set, ratio: float) -> set:
+    # Moves every n-th course elsewhere and drops as many, which makes a plan of updates and deletes
+    step = max(1, round(1 / ratio))
+    result = set()
+    for i, course in enumerate(sorted(courses, key=lambda c: (c.start_date, c.name))):
+        if i % step == 0:
+            result.add(dataclasses.replace(course, location=f'{course.location} (moved)'))
+        elif i % step != 1:
+            result.add(course)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Login, fetch, diff and apply benchmarks against local fake servers')
+    parser.add_argument('--events', type=int, default=10_000, help='events in the fake calendar')
+    parser.add_argument('--courses', type=int, default=40, help='timetable rows served by the fake jwxt')
+    parser.add_argument('--changes', type=int, default=200, help='courses inserted, updated and deleted per apply')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds the fake servers wait per request')
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--scenario', action='append', help='only run these scenarios')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+    # Per-event logging of the providers would dominate the apply timings
+    logging.basicConfig(level=logging.WARNING)
+
+    # Sessions, snapshots and the event store of the runs never touch the real cache
+    workdir = tempfile.TemporaryDirectory()
+    cache.cache_dir = workdir.name
+    executor = RequestExecutor(rate=1e9, burst=1e9)
+
+    nuist = FakeNUISTServer(args.courses, args.latency).start()
+    calendar = FakeCalendarServer(args.events, args.latency).start()
+    servers = [nuist, calendar]
+
+    def login():
+        _nuist.login_with_http(nuist.username, nuist.password, nuist.url, nuist.url)
+        return 1
+
+    provider = NUISTSourceProvider(nuist.username, nuist.password, first_school_day, '2024-2025-1',
+                                   authserver_url=nuist.url, jwxt_url=nuist.url)
+    provider.get_courses()
+
+    def fetch_nuist():
+        return len(provider.get_courses())
+
+    def fetch_google(**kwargs):
+        return lambda: len(google_source(calendar, executor, **kwargs).get_courses())
+
+    google_courses = google_source(calendar, executor).get_courses()
+    changed = edited(google_courses, 0.05)
+
+    def diff():
+        result = planner.plan(google_courses, changed)
+        return len(result.inserts) + len(result.deletes) + len(result.updates)
+
+    def apply_setup(batch_size: int):
+        counter = iter(range(sys.maxsize))
+
+        def setup():
+            # Fresh courses each round, so every round inserts, moves and deletes the same number of events
+            n = next(counter)
+            courses = [dataclasses.replace(c, name=f'{c.name} #{batch_size}.{n}')
+                       for c in sorted(google_courses, key=lambda c: c.name)[:args.changes]]
+            destination = GoogleDestinationProvider(api_key='bench', batch_size=batch_size, executor=executor,
+                                                    cache_responses=False, api_endpoint=f'{calendar.url}/',
+                                                    event_store=EventStore(f'bench_{batch_size}.sqlite3'))
+            return destination, courses
+        return setup
+
+    def apply(state):
+        destination, courses = state
+        moved = [dataclasses.replace(c, location=f'{c.location} (moved)') for c in courses]
+        destination.apply_plan(planner.ChangePlan(inserts=courses))
+        destination.apply_plan(planner.ChangePlan(updates=[planner.Update(old, new, ('location',))
+                                                           for old, new in zip(courses, moved)]))
+        destination.apply_plan(planner.ChangePlan(deletes=moved))
+        return 3 * len(courses)
+
+    scenarios = {
+        'login': lambda: measure('login', login, args.iterations, servers),
+        'fetch_nuist': lambda: measure('fetch_nuist', fetch_nuist, args.iterations, servers),
+        'fetch_google': lambda: measure('fetch_google', fetch_google(), args.iterations, servers),
+        'fetch_google_full': lambda: measure('fetch_google_full', fetch_google(lean_listing=False), args.iterations,
+                                             servers),
+        'fetch_google_incremental': lambda: measure('fetch_google_incremental', fetch_google(incremental=True),
+                                                    args.iterations, servers),
+        'diff': lambda: measure('diff', diff, args.iterations, servers),
+        'apply_batched': lambda: measure('apply_batched', apply, args.iterations, servers, apply_setup(50)),
+        'apply_unbatched': lambda: measure('apply_unbatched', apply, args.iterations, servers, apply_setup(1)),
+    }
+
+    results = []
+    try:
+        for name, scenario in scenarios.items():
+            if args.scenario is None or name in args.scenario:
+                results.append(scenario())
+    finally:
+        nuist.stop()
+        calendar.stop()
+        workdir.cleanup()
+
+    report = json.dumps({
+        'python': sys.version,
+        'timestamp': time.time(),
+        'date': datetime.datetime.now().isoformat(),
+        'parameters': vars(args),
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
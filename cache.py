@@ -1,4 +1,5 @@
-import os.path
+import os
+import tempfile
 
 cache_dir = os.path.join(os.path.dirname(__file__), 'cache')
 
@@ -11,10 +12,21 @@ def exists(file: str):
 
 
 def get_file(file: str):
-    if not os.path.exists(cache_dir):
-        os.mkdir(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
 
     return os.path.join(cache_dir, file)
 
 def remove(file: str):
-    os.remove(get_file(file))
\ No newline at end of file
+    os.remove(get_file(file))
+
+
+def write_atomic(file: str, content: str):
+    # Readers (and writers running at the same time) see either the old or the new content, never a mix
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(get_file(file)), prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.replace(temp, get_file(file))
+    except BaseException:
+        os.remove(temp)
+        raise
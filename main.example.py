@@ -1,6 +1,10 @@
 import datetime
 import logging
+import sys
 
+import cache
+import planner
+from metrics import default_metrics
 from provider.destination.google import GoogleDestinationProvider
 from provider.source.google import GoogleSourceProvider
 from provider.source.nuist import NUISTSourceProvider
@@ -14,27 +18,41 @@ source_provider = NUISTSourceProvider(
     password="Why do people attend class? Why do people have life?",
     first_school_day=first_school_day,
     semester="2024-2025-1",  # MUST be the semester you want to fetch
-    headless=True)  # Set to false if u wanna see stuff happen
+    headless=True,  # Set to false if u wanna see stuff happen
+    timetable_ttl=60 * 60)  # Seconds a fetched timetable is used without asking jwxt again
 
 if __name__ == '__main__':
     destination_provider = GoogleDestinationProvider(calendar_id)
+    if '--reconcile' in sys.argv:
+        with destination_provider:
+            destination_provider.reconcile(first_school_day)
+        sys.exit()
+
     gs_provider = GoogleSourceProvider(first_school_day=first_school_day, calendar_id=calendar_id)
 
     nuist_course = source_provider.get_courses()
-    gc_course = gs_provider.get_courses()
-
-    addition = nuist_course - gc_course
-    removal = gc_course - nuist_course
-
-    if addition:
-        print('+', *(e.name for e in addition))
-    if removal:
-        print('-', *(e.name for e in removal))
-
-    if not addition and not removal:
+    if source_provider.unchanged:
+        # Same timetable as at the last sync, no need to look at the calendar
         print("Today there's nothing to do.")
     else:
-        accept = input('Do you accept these changes? (y/N)')
-        if accept == 'y':
-            destination_provider.remove_courses(list(removal))
-            destination_provider.add_courses(list(addition))
+        gc_course = gs_provider.get_courses()
+        plan = planner.plan(gc_course, nuist_course)
+
+        if not plan:
+            print("Today there's nothing to do.")
+            source_provider.mark_synced()
+        else:
+            print(plan)
+            accept = input('Do you accept these changes? (y/N)')
+            if accept == 'y':
+                added, removed, updated = destination_provider.apply_plan(plan)
+                # Anything that failed (or is still pending in the journal) has to be looked at again next run
+                if (len(added), len(removed), len(updated)) == \
+                        (len(plan.inserts), len(plan.deletes), len(plan.updates)):
+                    source_provider.mark_synced()
+                else:
+                    print('Some changes did not go through, they are retried on the next run.')
+
+    # For cron runs, point node_exporter's textfile collector at a .prom file instead
+    logging.info(f'Metrics: {default_metrics}')
+    default_metrics.write_json(cache.get_file('metrics.json'))
@@ -0,0 +1,143 @@
+import functools
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Metrics:
+    # Timing spans (count, total and longest duration per name) and counters of a process, safe to share by threads
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__spans: dict[str, list] = {}
+        self.__counters: dict[str, float] = {}
+
+    def observe(self, name: str, seconds: float):
+        with self.__lock:
+            span = self.__spans.get(name)
+            if span is None:
+                self.__spans[name] = [1, seconds, seconds]
+            else:
+                span[0] += 1
+                span[1] += seconds
+                span[2] = max(span[2], seconds)
+
+    @contextmanager
+    def span(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str):
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return function(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def count(self, name: str, value: float = 1):
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def reset(self):
+        with self.__lock:
+            self.__spans.clear()
+            self.__counters.clear()
+
+    def snapshot(self) -> dict:
+        with self.__lock:
+            return {
+                'timestamp': time.time(),
+                'spans': {name: {'count': count, 'seconds': total, 'max_seconds': longest}
+                          for name, (count, total, longest) in sorted(self.__spans.items())},
+                'counters': dict(sorted(self.__counters.items())),
+            }
+
+    def to_prometheus(self, prefix: str = 'schedular') -> str:
+        # Text exposition format as read by node_exporter's textfile collector
+        snapshot = self.snapshot()
+        lines = [f'# TYPE {prefix}_span_seconds summary']
+        for name, span in snapshot['spans'].items():
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {span['count']}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {span['seconds']}')
+        lines.append(f'# TYPE {prefix}_span_max_seconds gauge')
+        for name, span in snapshot['spans'].items():
+            lines.append(f'{prefix}_span_max_seconds{{span="{name}"}} {span['max_seconds']}')
+        for name, value in snapshot['counters'].items():
+            metric = f'{prefix}_{re.sub(r'\W', '_', name)}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+        lines.append(f'# TYPE {prefix}_last_run_timestamp_seconds gauge')
+        lines.append(f'{prefix}_last_run_timestamp_seconds {snapshot['timestamp']}')
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, file: str):
+        _write_atomic(file, json.dumps(self.snapshot(), indent=2))
+
+    def write_prometheus(self, file: str, prefix: str = 'schedular'):
+        # The collector must never see a half written file, hence the rename
+        _write_atomic(file, self.to_prometheus(prefix))
+
+    def __str__(self):
+        snapshot = self.snapshot()
+        parts = [f'{name} {span['seconds']:.2f}s/{span['count']}' for name, span in snapshot['spans'].items()]
+        parts += [f'{name} {value:g}' for name, value in snapshot['counters'].items()]
+        return ', '.join(parts)
+
+
+def _write_atomic(file: str, content: str):
+    directory = os.path.dirname(os.path.abspath(file))
+    os.makedirs(directory, exist_ok=True)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(content)
+        os.chmod(temp, 0o644)
+        os.replace(temp, file)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+class CountingHttp:
+    # Wraps an httplib2.Http to count the bytes sent and received (after decompression), anything else is delegated
+    def __init__(self, http, prefix: str, metrics: Metrics = None):
+        self.__http = http
+        self.__prefix = prefix
+        self.__metrics = metrics if metrics is not None else default_metrics
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        response, content = self.__http.request(uri, method, body, headers, *args, **kwargs)
+        self.__metrics.count(f'{self.__prefix}.bytes_sent', len(body) if body else 0)
+        self.__metrics.count(f'{self.__prefix}.bytes_received', len(content) if content else 0)
+        return response, content
+
+    def __getattr__(self, name):
+        return getattr(self.__http, name)
+
+
+def count_response_bytes(session, prefix: str, metrics: Metrics = None):
+    # Same for a requests.Session, through a response hook
+    metrics = metrics if metrics is not None else default_metrics
+
+    def hook(response, *args, **kwargs):
+        body = response.request.body
+        metrics.count(f'{prefix}.bytes_sent', len(body) if body else 0)
+        metrics.count(f'{prefix}.bytes_received', len(response.content))
+
+    session.hooks['response'].append(hook)
+    return session
+
+
+# Shared by every provider of the process, exported once the run is over
+default_metrics = Metrics()
@@ -0,0 +1,76 @@
+import datetime
+from dataclasses import dataclass, field
+
+from provider.source.base import Course, WeeklyRecurrence
+
+weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+# Course fields an update may change, identity() covers everything else
+patchable_fields = ('location', 'recurrence', 'start_date', 'end_date')
+
+
+def last_occurrence(course: Course) -> datetime.datetime:
+    if isinstance(course.recurrence, WeeklyRecurrence):
+        weeks = (course.recurrence.count - 1) * course.recurrence.interval
+        return course.start_date + datetime.timedelta(weeks=weeks)
+    return course.start_date
+
+
+def identity(course: Course) -> tuple:
+    # Name, weekday, slot and week span: two courses sharing these are the same course, possibly edited
+    return (course.name, course.start_date.weekday(), course.start_date.time(), course.end_date.time(),
+            course.start_date.date(), last_occurrence(course).date())
+
+
+@dataclass
+class Update:
+    old: Course
+    new: Course
+    fields: tuple[str, ...]
+
+
+@dataclass
+class ChangePlan:
+    inserts: list[Course] = field(default_factory=list)
+    deletes: list[Course] = field(default_factory=list)
+    updates: list[Update] = field(default_factory=list)
+
+    def __bool__(self):
+        return bool(self.inserts or self.deletes or self.updates)
+
+    def __str__(self):
+        lines = [f'+ {describe(course)}' for course in self.inserts]
+        lines += [f'- {describe(course)}' for course in self.deletes]
+        for update in self.updates:
+            changes = ', '.join(f'{name} {getattr(update.old, name)!r} -> {getattr(update.new, name)!r}'
+                                for name in update.fields)
+            lines.append(f'~ {describe(update.new)}: {changes}')
+        return '\n'.join(lines)
+
+
+def describe(course: Course) -> str:
+    return (f'{course.name} ({weekdays[course.start_date.weekday()]} '
+            f'{course.start_date:%H:%M}-{course.end_date:%H:%M}, {course.location})')
+
+
+def plan(old: set[Course], new: set[Course]) -> ChangePlan:
+    # Courses only in one of the sets are paired up by identity, a pair becomes an update of the differing fields
+    removal = old - new
+    addition = new - old
+
+    candidates: dict[tuple, list[Course]] = {}
+    for course in sorted(removal, key=lambda c: (c.start_date, c.name)):
+        candidates.setdefault(identity(course), []).append(course)
+
+    result = ChangePlan()
+    for course in sorted(addition, key=lambda c: (c.start_date, c.name)):
+        matched = candidates.get(identity(course))
+        if matched:
+            previous = matched.pop(0)
+            fields = tuple(name for name in patchable_fields if getattr(previous, name) != getattr(course, name))
+            result.updates.append(Update(previous, course, fields))
+        else:
+            result.inserts.append(course)
+
+    result.deletes = [course for matched in candidates.values() for course in matched]
+    return result
@@ -0,0 +1,76 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import cache
+
+
+class EventStore:
+    # Maps course fingerprints to the calendar events created for them, per account and calendar (every account has
+    # a calendar called 'primary'). The database is opened on first use and may
+    # be used from any thread, one at a time. close() gives the connection back, the next use opens it again.
+    def __init__(self, file: str = 'events.sqlite3'):
+        self.__file = file
+        self.__connection = None
+        self.__lock = threading.Lock()
+
+    @contextmanager
+    def __connect(self):
+        with self.__lock:
+            if self.__connection is None:
+                connection = sqlite3.connect(cache.get_file(self.__file), timeout=30, check_same_thread=False)
+                with connection:
+                    columns = {row[1] for row in connection.execute('PRAGMA table_info(events)')}
+                    if columns and 'account' not in columns:
+                        # Rows of a store without accounts can't be told apart, events not found in the store are
+                        # looked up in the calendar (or the store rebuilt with reconcile())
+                        logging.info('Event store has no accounts, starting over')
+                        connection.execute('DROP TABLE events')
+                    connection.execute('CREATE TABLE IF NOT EXISTS events ('
+                                       'account TEXT NOT NULL, calendar_id TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+                                       'event_id TEXT NOT NULL, etag TEXT, '
+                                       'PRIMARY KEY (account, calendar_id, fingerprint))')
+                self.__connection = connection
+            yield self.__connection
+
+    def get(self, account: str, calendar_id: str, fingerprints: list[str]) -> dict[str, tuple[str, str]]:
+        if not fingerprints:
+            return {}
+        result = {}
+        with self.__connect() as connection:
+            # Stay below SQLite's limit of host parameters per statement
+            for i in range(0, len(fingerprints), 500):
+                chunk = fingerprints[i:i + 500]
+                rows = connection.execute(
+                    f'SELECT fingerprint, event_id, etag FROM events '
+                    f'WHERE account = ? AND calendar_id = ? AND fingerprint IN ({', '.join('?' * len(chunk))})',
+                    [account, calendar_id, *chunk])
+                result.update((fingerprint, (event_id, etag)) for fingerprint, event_id, etag in rows)
+        return result
+
+    def put(self, account: str, calendar_id: str, entries: list[tuple[str, str, str]]):
+        if not entries:
+            return
+        with self.__connect() as connection, connection:
+            connection.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                                   [(account, calendar_id, *entry) for entry in entries])
+
+    def remove(self, account: str, calendar_id: str, fingerprints: list[str]):
+        if not fingerprints:
+            return
+        with self.__connect() as connection, connection:
+            connection.executemany('DELETE FROM events WHERE account = ? AND calendar_id = ? AND fingerprint = ?',
+                                   [(account, calendar_id, fingerprint) for fingerprint in fingerprints])
+
+    def replace(self, account: str, calendar_id: str, entries: list[tuple[str, str, str]]):
+        with self.__connect() as connection, connection:
+            connection.execute('DELETE FROM events WHERE account = ? AND calendar_id = ?', (account, calendar_id))
+            connection.executemany('INSERT OR REPLACE INTO events VALUES (?, ?, ?, ?, ?)',
+                                   [(account, calendar_id, *entry) for entry in entries])
+
+    def close(self):
+        with self.__lock:
+            if self.__connection is not None:
+                self.__connection.close()
+                self.__connection = None
@@ -1,23 +1,43 @@
+import hashlib
+import json
+import logging
 import os
+import random
+import tempfile
+import threading
+import time
 from datetime import datetime
-from functools import cache as cache_fun
 from zoneinfo import ZoneInfo
 
-import google.auth.exceptions as ge
-import googleapiclient.discovery as gcp
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-
 import cache
+from metrics import default_metrics, CountingHttp
 from provider.source.base import Course, Recurrence
 
 
+@default_metrics.timed('google.event_to_course')
 def google_event_to_course(e) -> Course:
     return Course(name=e['summary'], location=e['location'] if 'location' in e else None,
                   start_date=datetime.fromisoformat(e['start']['dateTime']).replace(tzinfo=None),
                   end_date=datetime.fromisoformat(e['end']['dateTime']).replace(tzinfo=None),
-                  recurrence=Recurrence.from_ical_presentation(e['recurrence'][0]) if 'recurrence' in e else None)
+                  recurrence=Recurrence.from_ical_presentation('\n'.join(e['recurrence'])) if 'recurrence' in e else None)
+
+
+def course_to_google_event(course: Course) -> dict:
+    event = {
+        'summary': course.name,
+        'location': course.location,
+        'start': {
+            'dateTime': course.start_date.isoformat(),
+            'timeZone': 'Asia/Shanghai',
+        },
+        'end': {
+            'dateTime': course.end_date.isoformat(),
+            'timeZone': 'Asia/Shanghai',
+        },
+    }
+    if course.recurrence:
+        event['recurrence'] = course.recurrence.to_ical_presentation('Asia/Shanghai').splitlines()
+    return event
 
 
 class AuthorizationException(Exception):
@@ -27,70 +47,370 @@ class AuthorizationException(Exception):
         self.base_exception = base_exception
 
 
-class RetryException(Exception):
-    pass
+# The Google client libraries take a while to import, so modules get them through these once a request is made
+def http_error() -> type[Exception]:
+    from googleapiclient.errors import HttpError
+    return HttpError
+
+
+def _httplib2():
+    import httplib2
+    return httplib2
+
+
+def _error_reasons(e) -> set[str]:
+    # Calendar puts the reason into error.errors[], newer APIs into error.details[]
+    try:
+        error = json.loads(e.content)['error']
+    except (ValueError, KeyError, TypeError):
+        return set()
+    return {item.get('reason') for item in error.get('errors', []) + error.get('details', []) if isinstance(item, dict)}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.__rate = rate
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        # Takes the tokens right away and sleeps off the debt, if any. A batch larger than the bucket is charged in
+        # full, and whoever comes next waits until the debt is paid back, so the rate holds for batches as well.
+        with self.__lock:
+            now = time.monotonic()
+            self.__tokens = min(self.__capacity, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= tokens
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RequestExecutor:
+    # Calendar allows 600 queries per minute and user by default, the limiter keeps us right at that pace
+    def __init__(self, rate: float = 10, burst: float = 20, max_retries: int = 5, backoff_base: float = 1,
+                 backoff_cap: float = 32):
+        self.__bucket = TokenBucket(rate, burst)
+        self.__max_retries = max_retries
+        self.__backoff_base = backoff_base
+        self.__backoff_cap = backoff_cap
+        self.__lock = threading.Lock()
+        self.usage = {'calls': 0, 'retries': 0, 'failures': 0}
+
+    @property
+    def max_retries(self) -> int:
+        return self.__max_retries
+
+    def count(self, name: str, value: int = 1):
+        with self.__lock:
+            self.usage[name] += value
+        default_metrics.count(f'google.api_{name}', value)
+
+    def acquire(self, calls: int = 1):
+        self.__bucket.acquire(calls)
+        self.count('calls', calls)
+
+    def backoff(self, attempt: int):
+        # Exponential backoff with full jitter
+        time.sleep(random.uniform(0, min(self.__backoff_cap, self.__backoff_base * 2 ** attempt)))
+
+    @staticmethod
+    def is_retryable(e: Exception) -> bool:
+        if isinstance(e, http_error()):
+            if e.resp.status in (429, 500, 502, 503, 504):
+                return True
+            if e.resp.status == 403:
+                return bool(_error_reasons(e) & {'rateLimitExceeded', 'userRateLimitExceeded'})
+            return False
+        return isinstance(e, (ConnectionError, TimeoutError, _httplib2().HttpLib2Error))
+
+    def execute(self, request):
+        for attempt in range(self.__max_retries + 1):
+            self.acquire()
+            try:
+                return request.execute()
+            except Exception as e:
+                if attempt == self.__max_retries or not self.is_retryable(e):
+                    self.count('failures')
+                    raise
+                logging.warning(f'Retrying Google calendar request after {e}')
+                self.count('retries')
+                self.backoff(attempt)
+
+
+# Shared by every provider of the process, so the quota is accounted for as a whole
+default_executor = RequestExecutor()
+
+
+class ResponseCache:
+    # HTTP cache of one client for httplib2. Entries are replaced atomically, so jobs running at the same time never
+    # read one half written, and every client has its own directory, so accounts don't see each other's responses.
+    def __init__(self, directory: str):
+        self.__directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def __file(self, key: str) -> str:
+        return os.path.join(self.__directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self.__file(key), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key: str, value: bytes):
+        fd, temp = tempfile.mkstemp(dir=self.__directory, prefix='.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(value)
+            os.replace(temp, self.__file(key))
+        except BaseException:
+            os.remove(temp)
+            raise
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.__file(key))
+        except FileNotFoundError:
+            pass
+
+
+class ClientRegistry:
+    # Process-wide Google clients: one set of credentials per token file, one service (and keep-alive transport) per
+    # client and thread, as httplib2.Http isn't thread-safe, and the calendar metadata per client and calendar
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__key_locks: dict[tuple, threading.Lock] = {}
+        self.__documents: dict[str, str] = {}
+        self.__credentials: dict[str, object] = {}
+        self.__calendars: dict[tuple, dict] = {}
+        self.__local = threading.local()
+
+    def __key_lock(self, key: tuple) -> threading.Lock:
+        with self.__lock:
+            return self.__key_locks.setdefault(key, threading.Lock())
+
+    def document(self, root_url: str = None) -> str:
+        # Kept as text, build_from_document() adds parameters to the parsed document, so it can't be shared by threads
+        with self.__lock:
+            if root_url not in self.__documents:
+                from googleapiclient.discovery_cache import get_static_doc
+
+                document = get_static_doc('calendar', 'v3')
+                if root_url is not None:
+                    # Batch requests go to the document's rootUrl, so a different endpoint has to be patched in
+                    document = json.loads(document)
+                    document['rootUrl'] = root_url
+                    document = json.dumps(document)
+                self.__documents[root_url] = document
+            return self.__documents[root_url]
+
+    def credentials(self, token_file: str, credentials_file: str, callback_addr: str, callback_port: int):
+        from google.auth.transport.requests import Request
+        from google.oauth2.credentials import Credentials
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        with self.__key_lock(('credentials', token_file)):
+            credentials = self.__credentials.get(token_file)
+            if credentials is None and cache.exists(token_file):
+                credentials = Credentials.from_authorized_user_file(cache.get_file(token_file))
+
+            if not credentials or not credentials.valid:
+                if credentials and credentials.expired and credentials.refresh_token:
+                    credentials.refresh(Request())
+                else:
+                    scope = ['https://www.googleapis.com/auth/calendar']
+                    flow = InstalledAppFlow.from_client_secrets_file(credentials_file, scope)
+                    credentials = flow.run_local_server(bind_addr=callback_addr, port=callback_port)
+                    with cache.open_cache(token_file, 'w') as token:
+                        token.write(credentials.to_json())
+
+            self.__credentials[token_file] = credentials
+            return credentials
+
+    def forget(self, token_file: str):
+        with self.__lock:
+            self.__credentials.pop(token_file, None)
+
+    def service(self, key: tuple, credentials=None, api_key: str = None, api_endpoint: str = None,
+                cache_responses: bool = True):
+        import googleapiclient.discovery as gcp
+
+        services = getattr(self.__local, 'services', None)
+        if services is None:
+            services = self.__local.services = {}
+        cached = services.get(key)
+        if cached is not None and cached[0] is credentials:
+            return cached[1]
+
+        # googleapiclient already asks for gzip on every request (JsonModel sends accept-encoding: gzip, deflate).
+        # The file cache makes unchanged pages come back as 304 Not Modified through their ETag.
+        response_cache = None
+        if cache_responses:
+            # Named after a digest of the client key, which may hold an API key
+            digest = hashlib.sha256(repr(key).encode()).hexdigest()[:16]
+            response_cache = ResponseCache(cache.get_file(f'google_http/{digest}'))
+        http = CountingHttp(_httplib2().Http(cache=response_cache), 'google')
+        if credentials is not None:
+            from google_auth_httplib2 import AuthorizedHttp
+            http = AuthorizedHttp(credentials, http=http)
+
+        service = gcp.build_from_document(self.document(api_endpoint), developerKey=api_key, http=http)
+        services[key] = (credentials, service)
+        return service
+
+    def calendar(self, key: tuple, calendar_id: str, fetch) -> dict:
+        with self.__key_lock(('calendar', key, calendar_id)):
+            if (key, calendar_id) not in self.__calendars:
+                self.__calendars[key, calendar_id] = fetch()
+            return self.__calendars[key, calendar_id]
+
+
+default_registry = ClientRegistry()
+
+
+# Everything google_event_to_course() and the event store read, the rest of an event is never transferred
+event_fields = 'id,etag,status,summary,location,start,end,recurrence'
 
 
 class GoogleProvider:
     def __init__(self, calendar_id: str = 'primary', credentials_file: str = './cache/google_credentials.json',
                  token_file: str = 'google_token.json', callback_addr: str = 'localhost', callback_port: int = 24849,
-                 api_key: str = None):
+                 api_key: str = None, batch_size: int = 50, batch_attempts: int = 3,
+                 executor: RequestExecutor = None, lean_listing: bool = True, cache_responses: bool = True,
+                 api_endpoint: str = None):
         self._calendar_id = calendar_id
+        self.__api_endpoint = api_endpoint
+        self._lean_listing = lean_listing
+        self.__cache_responses = cache_responses
+        self._batch_size = batch_size
+        self._batch_attempts = batch_attempts
+        self._executor = executor if executor is not None else default_executor
         self.__credentials_file = credentials_file
         self.__callback_addr = callback_addr
         self.__callback_port = callback_port
         self.__token_file = token_file
         self.__api_key = api_key
-        self.__credentials = None
         self._service = None
 
-    @cache_fun
+    def _account(self) -> str:
+        # Tells the accounts (token file or API key, and endpoint) apart in cache file names and the event store,
+        # without spelling out an API key
+        return hashlib.sha256(repr(self.__client_key()[:3]).encode()).hexdigest()[:16]
+
+    def __client_key(self) -> tuple:
+        return ('key', self.__api_key, self.__api_endpoint, self.__cache_responses) if self.__api_key is not None \
+            else ('token', self.__token_file, self.__api_endpoint, self.__cache_responses)
+
     def _calendar_tz(self) -> ZoneInfo:
         self._login_or_fail()
-        info = self._service.calendars().get(calendarId=self._calendar_id).execute()
+        info = default_registry.calendar(self.__client_key(), self._calendar_id, lambda: self._executor.execute(
+            self._service.calendars().get(calendarId=self._calendar_id)))
         return ZoneInfo(info['timeZone']) if 'timeZone' in info else ZoneInfo('utc')
 
+    def _list_pages(self, **kwargs):
+        # Yields every page of events().list, following nextPageToken until the last page.
+        if self._lean_listing:
+            # 2500 is the largest page the API serves
+            kwargs = {'maxResults': 2500, 'fields': f'nextPageToken,nextSyncToken,items({event_fields})', **kwargs}
+        page_token = None
+        while True:
+            with default_metrics.span('google.list_page'):
+                events = self._executor.execute(self._service.events().list(calendarId=self._calendar_id,
+                                                                            pageToken=page_token, **kwargs))
+            yield events
+
+            if 'nextPageToken' in events:
+                page_token = events['nextPageToken']
+            else:
+                break
+
+    def _list_events(self, **kwargs):
+        for page in self._list_pages(**kwargs):
+            yield from page['items']
+
+    def _execute_batch(self, requests: dict[str, object]) -> tuple[dict[str, object], dict[str, Exception]]:
+        # Sends requests through the batch endpoint, retrying only the sub-requests that failed for a retryable reason.
+        # A chunk of one request (always so with batch_size=1) is sent on its own, without the multipart framing.
+        responses = {}
+        errors = {}
+        pending = dict(requests)
+        for attempt in range(self._batch_attempts):
+            failed = {}
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                    errors.pop(request_id, None)
+                else:
+                    failed[request_id] = exception
+
+            keys = list(pending)
+            for i in range(0, len(keys), self._batch_size):
+                chunk = keys[i:i + self._batch_size]
+                if len(chunk) == 1:
+                    self._executor.acquire()
+                    try:
+                        with default_metrics.span('google.request'):
+                            callback(chunk[0], pending[chunk[0]].execute(), None)
+                    except Exception as e:
+                        callback(chunk[0], None, e)
+                    continue
+
+                batch = self._service.new_batch_http_request(callback=callback)
+                for key in chunk:
+                    batch.add(pending[key], request_id=key)
+                # Every sub-request counts against the quota
+                self._executor.acquire(len(chunk))
+                try:
+                    with default_metrics.span('google.batch'):
+                        batch.execute()
+                except Exception as e:
+                    for key in chunk:
+                        if key not in responses:
+                            failed[key] = e
+
+            errors.update(failed)
+            retry = {key for key, e in failed.items() if self._executor.is_retryable(e)}
+            if not retry or attempt == self._batch_attempts - 1:
+                break
+            logging.warning(f'{len(retry)} of {len(pending)} batched requests failed, retrying (attempt {attempt + 1})')
+            self._executor.count('retries', len(retry))
+            self._executor.backoff(attempt)
+            pending = {key: pending[key] for key in retry}
+
+        self._executor.count('failures', len(errors))
+        return responses, errors
+
     def _login_or_fail(self):
-        if not self._service:
+        # The Google client libraries take a while to import, so they are only loaded once a login is needed
+        import google.auth.exceptions as ge
+
+        # A revoked token is dropped and the login tried once more, which starts a new authorization flow
+        for attempt in range(2):
+            if self._service:
+                return
             try:
                 self._login()
             except ge.TransportError as e:
                 raise AuthorizationException(
                     'Google calendar failed due to network error', e)
             except ge.RefreshError as e:
-                if e.args[1]['error'] == 'invalid_grant':
-                    os.remove(cache.get_file(self.__token_file))
-                    self.__credentials = None
-                    self._service = None
-                    raise RetryException()
-                else:
+                if e.args[1]['error'] != 'invalid_grant' or attempt > 0:
                     raise AuthorizationException('Failed to refresh Google calendar', e)
+                os.remove(cache.get_file(self.__token_file))
+                default_registry.forget(self.__token_file)
+                self._service = None
             except ge.GoogleAuthError as e:
                 raise AuthorizationException('Failed to authorized Google calendar', e)
 
     def _login(self):
+        credentials = None
         if self.__api_key is None:
-            if cache.exists(self.__token_file):
-                self.__credentials = Credentials.from_authorized_user_file(
-                    cache.get_file(self.__token_file))
-
-            updated = False
-            if not self.__credentials or not self.__credentials.valid:
-                updated = True
-                if self.__credentials and self.__credentials.expired and self.__credentials.refresh_token:
-                    self.__credentials.refresh(Request())
-                else:
-                    scope = ['https://www.googleapis.com/auth/calendar']
-                    flow = InstalledAppFlow.from_client_secrets_file(
-                        self.__credentials_file, scope)
-                    self.__credentials = flow.run_local_server(
-                        bind_addr=self.__callback_addr, port=self.__callback_port)
-                    with cache.open_cache(self.__token_file, 'w') as token:
-                        token.write(self.__credentials.to_json())
-
-            if not self._service or updated:
-                self._service = gcp.build(
-                    'calendar', 'v3', credentials=self.__credentials)
-        else:
-            self._service = gcp.build(
-                'calendar', 'v3', developerKey=self.__api_key)
+            credentials = default_registry.credentials(self.__token_file, self.__credentials_file,
+                                                       self.__callback_addr, self.__callback_port)
+        self._service = default_registry.service(self.__client_key(), credentials, self.__api_key,
+                                                 self.__api_endpoint, self.__cache_responses)
@@ -0,0 +1,171 @@
+import datetime
+import hashlib
+import os
+import tempfile
+from typing import Iterable, Iterator
+from zoneinfo import ZoneInfo
+
+from provider.source.base import Course, Recurrence
+
+# Events are only ever replaced under a new UID (the UID is the fingerprint), so a fixed DTSTAMP is enough and keeps
+# the output of the same courses byte for byte the same
+dtstamp = '19700101T000000Z'
+product_id = '-//Schedular//Schedular//EN'
+
+
+def escape(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def unescape(text: str) -> str:
+    result = []
+    chars = iter(text)
+    for char in chars:
+        if char == '\\':
+            char = next(chars, '')
+            result.append('\n' if char in 'nN' else char)
+        else:
+            result.append(char)
+    return ''.join(result)
+
+
+def fold(line: str) -> Iterator[str]:
+    # Content lines are at most 75 octets, continuation lines start with a space. Never splits a UTF-8 sequence.
+    encoded = line.encode()
+    while len(encoded) > 75:
+        cut = 75
+        while encoded[cut] & 0xC0 == 0x80:
+            cut -= 1
+        yield encoded[:cut].decode()
+        encoded = b' ' + encoded[cut:]
+    yield encoded.decode()
+
+
+def unfold(lines: Iterable[str]) -> Iterator[str]:
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t') and current is not None:
+            current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def _format(date: datetime.datetime) -> str:
+    return date.strftime('%Y%m%dT%H%M%S')
+
+
+def calendar_lines(courses: Iterable[Course], name: str, tzid: str) -> Iterator[str]:
+    courses = sorted(courses, key=lambda c: (c.start_date, c.name, c.fingerprint))
+    yield 'BEGIN:VCALENDAR'
+    yield 'VERSION:2.0'
+    yield f'PRODID:{product_id}'
+    yield 'CALSCALE:GREGORIAN'
+    yield f'X-WR-CALNAME:{escape(name)}'
+    yield f'X-WR-TIMEZONE:{tzid}'
+
+    # A single fixed offset, right for zones without daylight saving time such as Asia/Shanghai
+    offset = datetime.datetime(2000, 1, 1, tzinfo=ZoneInfo(tzid)).strftime('%z')
+    yield 'BEGIN:VTIMEZONE'
+    yield f'TZID:{tzid}'
+    yield 'BEGIN:STANDARD'
+    yield 'DTSTART:19700101T000000'
+    yield f'TZOFFSETFROM:{offset}'
+    yield f'TZOFFSETTO:{offset}'
+    yield 'END:STANDARD'
+    yield 'END:VTIMEZONE'
+
+    for course in courses:
+        yield 'BEGIN:VEVENT'
+        yield f'UID:{course.fingerprint}@schedular'
+        yield f'DTSTAMP:{dtstamp}'
+        yield f'DTSTART;TZID={tzid}:{_format(course.start_date)}'
+        yield f'DTEND;TZID={tzid}:{_format(course.end_date)}'
+        yield f'SUMMARY:{escape(course.name)}'
+        if course.location is not None:
+            yield f'LOCATION:{escape(course.location)}'
+        if course.recurrence:
+            yield from course.recurrence.to_ical_presentation(tzid).splitlines()
+        yield 'END:VEVENT'
+    yield 'END:VCALENDAR'
+
+
+def file_digest(file: str) -> str:
+    if not os.path.exists(file):
+        return None
+    with open(file, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+def write_calendar(file: str, courses: Iterable[Course], name: str, tzid: str) -> bool:
+    # Streams the calendar into a temporary file next to the target, which only replaces the target if the content
+    # changed. Returns whether it did.
+    directory = os.path.dirname(os.path.abspath(file))
+    os.makedirs(directory, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.', suffix='.ics.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as f:
+            for line in calendar_lines(courses, name, tzid):
+                for part in fold(line):
+                    content = f'{part}\r\n'
+                    digest.update(content.encode())
+                    f.write(content)
+
+        if digest.hexdigest() == file_digest(file):
+            os.remove(temp)
+            return False
+        os.chmod(temp, 0o644)
+        os.replace(temp, file)
+        return True
+    except BaseException:
+        if os.path.exists(temp):
+            os.remove(temp)
+        raise
+
+
+def _parse_date(value: str, params: dict[str, str], tz: ZoneInfo) -> datetime.datetime:
+    if value.endswith('Z'):
+        date = datetime.datetime.strptime(value, '%Y%m%dT%H%M%SZ').replace(tzinfo=datetime.UTC)
+        return date.astimezone(tz).replace(tzinfo=None)
+    if 'T' not in value:
+        return datetime.datetime.strptime(value, '%Y%m%d')
+    date = datetime.datetime.strptime(value, '%Y%m%dT%H%M%S')
+    if 'TZID' in params and params['TZID'] != tz.key:
+        date = date.replace(tzinfo=ZoneInfo(params['TZID'])).astimezone(tz).replace(tzinfo=None)
+    return date
+
+
+def read_courses(file: str, tzid: str) -> Iterator[Course]:
+    # Yields the courses of the VEVENTs one by one while reading the file, dates in local time of tzid
+    tz = ZoneInfo(tzid)
+    with open(file, 'r', encoding='utf-8', newline='') as f:
+        event = None
+        for line in unfold(f):
+            if line == 'BEGIN:VEVENT':
+                event = {'recurrence': []}
+                continue
+            if event is None:
+                continue
+            if line == 'END:VEVENT':
+                recurrence = Recurrence.from_ical_presentation('\n'.join(event['recurrence'])) \
+                    if event['recurrence'] else None
+                yield Course(name=event.get('SUMMARY', ''), location=event.get('LOCATION'), recurrence=recurrence,
+                             start_date=event['DTSTART'], end_date=event['DTEND'])
+                event = None
+                continue
+
+            head, _, value = line.partition(':')
+            name, *parameters = head.split(';')
+            params = dict(p.split('=', 1) for p in parameters if '=' in p)
+            match name.upper():
+                case 'SUMMARY' | 'LOCATION':
+                    event[name.upper()] = unescape(value)
+                case 'DTSTART' | 'DTEND':
+                    event[name.upper()] = _parse_date(value, params, tz)
+                case 'RRULE' | 'EXDATE':
+                    event['recurrence'].append(line)
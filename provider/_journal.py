@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+import uuid
+
+import cache
+
+# One lock per journal file and process, whichever Journal object (e.g. of concurrent jobs) writes it
+_file_locks: dict[str, threading.Lock] = {}
+_file_locks_lock = threading.Lock()
+
+
+def _file_lock(file: str) -> threading.Lock:
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(cache.get_file(file)), threading.Lock())
+
+
+class Journal:
+    # Write-ahead log of calendar writes. Operations are appended before they are sent and settled once their outcome
+    # is known, so the operations of a run that died halfway can be finished by the next one.
+    def __init__(self, file: str):
+        self.__file = file
+        self.__lock = _file_lock(file)
+
+    @staticmethod
+    def new_key() -> str:
+        return uuid.uuid4().hex
+
+    def __append(self, records: list[dict]):
+        if not records:
+            return
+        with self.__lock, cache.open_cache(self.__file, 'a') as f:
+            f.write(''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def plan(self, operations: list[dict]):
+        self.__append([{'type': 'plan', **operation} for operation in operations])
+
+    def settle(self, keys: list[str], outcome: str = 'done'):
+        self.__append([{'type': outcome, 'key': key} for key in keys])
+
+    def pending(self) -> list[dict]:
+        with self.__lock:
+            return self.__read()
+
+    def __read(self) -> list[dict]:
+        if not cache.exists(self.__file):
+            return []
+
+        operations = {}
+        with cache.open_cache(self.__file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last line of a run killed while writing it
+                    continue
+                if record['type'] == 'plan':
+                    operations[record['key']] = {key: value for key, value in record.items() if key != 'type'}
+                else:
+                    operations.pop(record['key'], None)
+        return list(operations.values())
+
+    def compact(self):
+        # Starts over once nothing is pending, so the journal only grows with unfinished work. Checked and removed
+        # under the one lock, records planned in between can't get lost.
+        with self.__lock:
+            if cache.exists(self.__file) and not self.__read():
+                cache.remove(self.__file)
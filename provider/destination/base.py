@@ -1,3 +1,4 @@
+from planner import ChangePlan, Update
 from provider.source.base import Course
 
 class DestinationProvider:
@@ -8,4 +9,25 @@ class DestinationProvider:
         raise NotImplementedError("Method not implemented")
 
     def add_courses(self, courses: list[Course]):
-        raise NotImplementedError("Method not implemented")
\ No newline at end of file
+        raise NotImplementedError("Method not implemented")
+
+    def update_courses(self, updates: list[Update]) -> list:
+        # Providers that can't edit in place replace the old course
+        self.remove_courses([update.old for update in updates])
+        return self.add_courses([update.new for update in updates])
+
+    def apply_plan(self, plan: ChangePlan) -> tuple[list, list, list]:
+        removed = self.remove_courses(plan.deletes) if plan.deletes else []
+        updated = self.update_courses(plan.updates) if plan.updates else []
+        added = self.add_courses(plan.inserts) if plan.inserts else []
+        return added, removed, updated
+
+    def close(self):
+        # Gives back what the provider holds open between calls
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,93 +1,352 @@
 import logging
+import re
+from datetime import datetime
 
-from provider._google import GoogleProvider, AuthorizationException, google_event_to_course, RetryException
+from metrics import default_metrics
+from planner import ChangePlan, Update
+from provider._event_store import EventStore
+from provider._journal import Journal
+from provider._google import GoogleProvider, AuthorizationException, google_event_to_course, \
+    course_to_google_event, RequestExecutor, http_error
 from provider.destination.base import DestinationProvider
 from provider.source.base import Course
 
 
+# Google event key holding each patchable course field
+_event_keys = {
+    'location': 'location',
+    'recurrence': 'recurrence',
+    'start_date': 'start',
+    'end_date': 'end',
+}
+
+
 class GoogleDestinationProvider(DestinationProvider, GoogleProvider):
 
     def __init__(self, calendar_id: str = 'primary', credentials_file: str = './cache/google_credentials.json',
                  token_file: str = 'google_token.json', callback_addr: str = 'localhost', callback_port: int = 24849,
-                 api_key: str = None):
+                 api_key: str = None, batch_size: int = 50, batch_attempts: int = 3, event_store: EventStore = None,
+                 executor: RequestExecutor = None, lean_listing: bool = True, cache_responses: bool = True,
+                 api_endpoint: str = None, journal: Journal = None):
         DestinationProvider.__init__(self)
         GoogleProvider.__init__(self, calendar_id, credentials_file, token_file, callback_addr, callback_port,
-                                api_key)
+                                api_key, batch_size, batch_attempts, executor, lean_listing, cache_responses,
+                                api_endpoint)
+        self.__event_store = event_store if event_store is not None else EventStore()
+        self.__journal = journal if journal is not None else \
+            Journal(f'journal_{self._account()}_{re.sub(r'[^\w.@-]', '_', calendar_id)}.jsonl')
 
+    @default_metrics.timed('google.remove_courses')
     def remove_courses(self, courses: list[Course]) -> list:
         try:
             self._login_or_fail()
-        except RetryException:
-            return self.remove_courses(courses)
         except AuthorizationException as e:
             logging.error(e.message, exc_info=e.base_exception)
             return []
         if len(courses) <= 0:
             return []
 
+        # Courses created by us are deleted by their stored ID, only the others need a calendar listing
+        fingerprints = [course.fingerprint for course in courses]
+        known = self.__event_store.get(self._account(), self._calendar_id, fingerprints)
+
+        operations = []
+        unknown = []
+        for course, fingerprint in zip(courses, fingerprints):
+            if fingerprint in known:
+                operations.append(self.__operation('delete', course, known[fingerprint][0]))
+            else:
+                unknown.append(course)
+        if unknown:
+            operations.extend(self.__operation('delete', course, event['id'])
+                              for course, event in self.__match_events(unknown))
+
+        _, errors = self.__run(operations)
+
+        removed = []
+        for operation in operations:
+            event = {'id': operation['event_id'], 'summary': operation['name']}
+            if operation['key'] in errors:
+                logging.error(f'Failed to remove event. Name: {event['summary']}, ID: {event['id']}: '
+                              f'{errors[operation['key']]}')
+            else:
+                logging.info(f'Event removed. Name: {event['summary']}, ID: {event['id']}')
+                removed.append(event)
+
+        return removed
+
+    def __match_events(self, courses: list[Course]) -> list[tuple[Course, dict]]:
         earliest_day = courses[0].start_date
+        latest_day = courses[0].end_date
         for course in courses[1:]:
             if course.start_date < earliest_day:
                 earliest_day = course.start_date
+            if course.end_date > latest_day:
+                latest_day = course.end_date
 
+        # timeMax bounds the (first) start of an event, so the window ends with the last course
         time_min = earliest_day.replace(tzinfo=self._calendar_tz()) if earliest_day.tzinfo is None else earliest_day
-        events = self._service.events().list(calendarId=self._calendar_id, timeMin=time_min.isoformat()).execute()
+        time_max = latest_day.replace(tzinfo=self._calendar_tz()) if latest_day.tzinfo is None else latest_day
 
-        course_remaining = list(courses)
-        events_removal = []
-        for event in events['items']:
-            if 'summary' not in event:
+        # Index the calendar by course so that matching is a hash lookup per course.
+        names = {course.name for course in courses}
+        index: dict[Course, list] = {}
+        for event in self._list_events(timeMin=time_min.isoformat(), timeMax=time_max.isoformat()):
+            if 'summary' not in event or event['summary'] not in names:
                 continue
-            for course in courses:
-                if course.name != event['summary'] or google_event_to_course(event) != course:
-                    continue
+            index.setdefault(google_event_to_course(event), []).append(event)
 
-                course_remaining.remove(course)
-                events_removal.append(event)
+        course_remaining = []
+        events_removal = []
+        for course in courses:
+            matched = index.pop(course, None)
+            if matched:
+                events_removal.extend((course, event) for event in matched)
+            else:
+                course_remaining.append(course)
 
         if course_remaining:
             raise LookupError(f'{', '.join(c.name for c in course_remaining)} are not available in calendar')
 
-        events_service = self._service.events()
-        for event in events_removal:
-            events_service.delete(calendarId=self._calendar_id, eventId=event['id']).execute()
-            logging.info(f'Event removed. Name: {event['summary']}, ID: {event['id']}')
-
         return events_removal
 
-    def add_courses(self, courses: list[Course]) -> list:
+    @default_metrics.timed('google.update_courses')
+    def update_courses(self, updates: list[Update]) -> list:
         try:
             self._login_or_fail()
-        except RetryException:
-            return self.add_courses(courses)
         except AuthorizationException as e:
             logging.error(e.message, exc_info=e.base_exception)
             return []
+        if len(updates) <= 0:
+            return []
+
+        old_courses = [update.old for update in updates]
+        known = self.__event_store.get(self._account(), self._calendar_id,
+                                       [course.fingerprint for course in old_courses])
+        event_ids = {course: known[course.fingerprint][0] for course in old_courses if course.fingerprint in known}
+        unknown = [course for course in old_courses if course not in event_ids]
+        if unknown:
+            event_ids.update((course, event['id']) for course, event in self.__match_events(unknown))
+
+        # Only the changed fields are sent, which keeps the event (and its history) in place
+        operations = []
+        for update in updates:
+            event = course_to_google_event(update.new)
+            body = {}
+            for name in update.fields:
+                key = _event_keys[name]
+                body[key] = event.get(key, [] if key == 'recurrence' else None)
+            operations.append(self.__operation('patch', update.new, event_ids[update.old], body,
+                                               old_fingerprint=update.old.fingerprint))
 
+        responses, errors = self.__run(operations)
+
+        events = []
+        for update, operation in zip(updates, operations):
+            if operation['key'] in errors:
+                logging.error(f'Failed to update event. Name: {update.new.name}: {errors[operation['key']]}')
+                continue
+            event = responses[operation['key']]
+            logging.info(f'Event updated. Name: {update.new.name}, ID: {event['id']}, fields: {', '.join(update.fields)}')
+            events.append(event)
+
+        return events
+
+    def reconcile(self, first_day: datetime = None) -> int:
+        # Rebuilds the event store from what is actually in the calendar
         try:
-            events = []
-            for course in courses:
-                event = {
-                    'summary': course.name,
-                    'location': course.location,
-                    'start': {
-                        'dateTime': course.start_date.isoformat(),
-                        'timeZone': 'Asia/Shanghai',
-                    },
-                    'end': {
-                        'dateTime': course.end_date.isoformat(),
-                        'timeZone': 'Asia/Shanghai',
-                    },
-                }
-                if course.recurrence:
-                    event['recurrence'] = [course.recurrence.to_ical_presentation()]
-
-                event = self._service.events().insert(
-                    calendarId=self._calendar_id, body=event).execute()
+            self._login_or_fail()
+        except AuthorizationException as e:
+            logging.error(e.message, exc_info=e.base_exception)
+            return 0
+
+        kwargs = {}
+        if first_day is not None:
+            time_min = first_day.replace(tzinfo=self._calendar_tz()) if first_day.tzinfo is None else first_day
+            kwargs['timeMin'] = time_min.isoformat()
+
+        entries = [(google_event_to_course(event).fingerprint, event['id'], event.get('etag'))
+                   for event in self._list_events(**kwargs)
+                   if 'summary' in event and 'dateTime' in event.get('start', {})]
+        self.__event_store.replace(self._account(), self._calendar_id, entries)
+        logging.info(f'Event store reconciled with {len(entries)} events')
+        return len(entries)
+
+    @default_metrics.timed('google.add_courses')
+    def add_courses(self, courses: list[Course]) -> list:
+        try:
+            self._login_or_fail()
+        except AuthorizationException as e:
+            logging.error(e.message, exc_info=e.base_exception)
+            return []
+
+        # The event ID is the fingerprint (hex digits are valid base32hex), so sending an insert twice can't create
+        # a second event
+        operations = [self.__operation('insert', course, course.fingerprint,
+                                       {'id': course.fingerprint, **course_to_google_event(course)})
+                      for course in courses]
+        responses, errors = self.__run(operations)
+
+        events = []
+        for course, operation in zip(courses, operations):
+            if operation['key'] in errors:
+                logging.error(f'Failed to create event. Name: {course.name}: {errors[operation['key']]}')
+            else:
+                event = responses[operation['key']]
                 logging.info(
                     f'Event created! Name: {course.name}, ID: {event.get("id")}')
                 events.append(event)
-            return events
-        except Exception as e:
-            logging.error(f'Failed to set courses to Google calendar: {e}')
+        return events
+
+    def apply_plan(self, plan: ChangePlan) -> tuple[list, list, list]:
+        try:
+            plan, (added, removed, updated) = self.__skip_resumed(plan, self.__resume())
+            more_added, more_removed, more_updated = super().apply_plan(plan)
+            return added + more_added, removed + more_removed, updated + more_updated
+        finally:
+            self.close()
+
+    @staticmethod
+    def __skip_resumed(plan: ChangePlan, done: list[tuple[dict, object]]) -> tuple[ChangePlan, tuple[list, list, list]]:
+        # The plan was made from a listing taken before the resume. What the resume just did is taken out of it and
+        # reported as done, instead of being looked for in a calendar (and an event store) that no longer has it.
+        inserted = {operation['fingerprint']: event for operation, event in done if operation['kind'] == 'insert'}
+        deleted = {operation['fingerprint']: operation for operation, _ in done if operation['kind'] == 'delete'}
+        patched = {operation['old_fingerprint']: (operation, event) for operation, event in done
+                   if operation['kind'] == 'patch'}
+
+        added = [inserted[course.fingerprint] for course in plan.inserts if course.fingerprint in inserted]
+        removed = [{'id': deleted[course.fingerprint]['event_id'], 'summary': course.name}
+                   for course in plan.deletes if course.fingerprint in deleted]
+        # An update that the resumed patch only did in part is left to the next run, which sees the rest of it
+        updated = [patched[update.old.fingerprint][1] for update in plan.updates
+                   if update.old.fingerprint in patched and
+                   patched[update.old.fingerprint][0]['fingerprint'] == update.new.fingerprint]
+        remaining = ChangePlan(
+            inserts=[course for course in plan.inserts if course.fingerprint not in inserted],
+            deletes=[course for course in plan.deletes if course.fingerprint not in deleted],
+            updates=[update for update in plan.updates if update.old.fingerprint not in patched])
+        return remaining, (added, removed, updated)
+
+    def close(self):
+        # The event store reopens on its next use
+        self.__event_store.close()
+
+    def resume(self) -> int:
+        # Finishes the operations a previous run journaled but never settled, e.g. because it crashed or ran out of
+        # retries. Returns how many got through.
+        return len(self.__resume())
+
+    def __resume(self) -> list[tuple[dict, object]]:
+        # The operations that got through, each with its response
+        operations = self.__journal.pending()
+        if not operations:
+            return []
+        try:
+            self._login_or_fail()
+        except AuthorizationException as e:
+            logging.error(e.message, exc_info=e.base_exception)
             return []
+
+        logging.info(f'Resuming {len(operations)} journaled calendar operations')
+        responses, errors = self.__run(operations, journaled=True)
+        done = []
+        for operation in operations:
+            if operation['key'] in errors:
+                logging.error(f'Failed to resume {operation['kind']} of event. Name: {operation['name']}: '
+                              f'{errors[operation['key']]}')
+            else:
+                done.append((operation, responses.get(operation['key'])))
+        return done
+
+    @staticmethod
+    def __operation(kind: str, course: Course, event_id: str, body: dict = None, **extra) -> dict:
+        operation = {'key': Journal.new_key(), 'kind': kind, 'name': course.name, 'fingerprint': course.fingerprint,
+                     'event_id': event_id, **extra}
+        if body is not None:
+            operation['body'] = body
+        return operation
+
+    def __run(self, operations: list[dict], journaled: bool = False) -> tuple[dict[str, object], dict[str, Exception]]:
+        # Journals and sends the operations, then settles them and keeps the event store in step with what got through
+        if not journaled:
+            self.__journal.plan(operations)
+
+        events_service = self._service.events()
+        requests = {}
+        for operation in operations:
+            match operation['kind']:
+                case 'insert':
+                    request = events_service.insert(calendarId=self._calendar_id, body=operation['body'])
+                case 'delete':
+                    request = events_service.delete(calendarId=self._calendar_id, eventId=operation['event_id'])
+                case _:
+                    request = events_service.patch(calendarId=self._calendar_id, eventId=operation['event_id'],
+                                                   body=operation['body'])
+            requests[operation['key']] = request
+        responses, errors = self._execute_batch(requests)
+
+        http_error_type = http_error()
+        conflicts = [operation for operation in operations if operation['kind'] == 'insert' and
+                     isinstance(errors.get(operation['key']), http_error_type) and
+                     errors[operation['key']].resp.status == 409]
+        if conflicts:
+            self.__restore(conflicts, responses, errors)
+
+        settled = []
+        failed = []
+        removals = []
+        entries = []
+        for operation in operations:
+            key = operation['key']
+            error = errors.get(key)
+            if operation['kind'] == 'delete' and isinstance(error, http_error_type) and error.resp.status in (404, 410):
+                # Gone already
+                del errors[key]
+                error = None
+            if error is not None:
+                # Operations that may succeed later stay pending for the next resume()
+                if not self._executor.is_retryable(error):
+                    failed.append(key)
+                continue
+
+            settled.append(key)
+            if operation['kind'] == 'delete':
+                removals.append(operation['fingerprint'])
+            else:
+                if 'old_fingerprint' in operation:
+                    removals.append(operation['old_fingerprint'])
+                entries.append((operation['fingerprint'], responses[key]['id'], responses[key].get('etag')))
+
+        self.__event_store.remove(self._account(), self._calendar_id, removals)
+        self.__event_store.put(self._account(), self._calendar_id, entries)
+        self.__journal.settle(settled)
+        self.__journal.settle(failed, 'failed')
+        self.__journal.compact()
+        return responses, errors
+
+    def __restore(self, operations: list[dict], responses: dict, errors: dict):
+        # The ID of an insert is taken: either an interrupted run created the event already, which is kept, or it was
+        # deleted since (deleted events keep their ID), which is brought back with the new content
+        events_service = self._service.events()
+        found, _ = self._execute_batch({operation['key']: events_service.get(calendarId=self._calendar_id,
+                                                                              eventId=operation['event_id'])
+                                        for operation in operations})
+        requests = {}
+        for operation in operations:
+            event = found.get(operation['key'])
+            if event is None:
+                continue
+            if event.get('status') == 'cancelled':
+                requests[operation['key']] = events_service.update(
+                    calendarId=self._calendar_id, eventId=operation['event_id'],
+                    body={**operation['body'], 'status': 'confirmed'})
+            else:
+                responses[operation['key']] = event
+                del errors[operation['key']]
+
+        restored, failures = self._execute_batch(requests)
+        for key, event in restored.items():
+            responses[key] = event
+            errors.pop(key, None)
+        errors.update(failures)
@@ -0,0 +1,59 @@
+import logging
+
+from metrics import default_metrics
+from planner import ChangePlan, Update
+from provider import _ics
+from provider.destination.base import DestinationProvider
+from provider.source.base import Course
+from provider.source.ics import ICSSourceProvider
+
+
+class ICSDestinationProvider(DestinationProvider):
+    # Keeps the courses in an iCalendar file. Every change rewrites the file, atomically and only if its content changed.
+    def __init__(self, file: str, calendar_name: str = 'Schedular', tzid: str = 'Asia/Shanghai'):
+        super().__init__()
+        self.__file = file
+        self.__calendar_name = calendar_name
+        self.__tzid = tzid
+
+    def get_courses(self) -> set[Course]:
+        return ICSSourceProvider(self.__file, self.__tzid).get_courses()
+
+    def set_courses(self, courses: set[Course]) -> bool:
+        with default_metrics.span('ics.write'):
+            written = _ics.write_calendar(self.__file, courses, self.__calendar_name, self.__tzid)
+        if written:
+            logging.info(f'Wrote {len(courses)} courses to {self.__file}')
+        else:
+            logging.info(f'{self.__file} is up to date')
+        return written
+
+    def remove_courses(self, courses: list[Course]) -> list:
+        return self.apply_plan(ChangePlan(deletes=courses))[1]
+
+    def add_courses(self, courses: list[Course]) -> list:
+        return self.apply_plan(ChangePlan(inserts=courses))[0]
+
+    def update_courses(self, updates: list[Update]) -> list:
+        return self.apply_plan(ChangePlan(updates=updates))[2]
+
+    def apply_plan(self, plan: ChangePlan) -> tuple[list, list, list]:
+        # The whole plan goes into a single rewrite
+        courses = self.get_courses()
+        removed = [course for course in plan.deletes if course in courses]
+        courses.difference_update(plan.deletes)
+
+        updated = []
+        for update in plan.updates:
+            if update.old in courses:
+                courses.discard(update.old)
+                courses.add(update.new)
+                updated.append(update.new)
+            else:
+                logging.error(f'Failed to update course, not in {self.__file}. Name: {update.old.name}')
+
+        added = [course for course in plan.inserts if course not in courses]
+        courses.update(plan.inserts)
+
+        self.set_courses(courses)
+        return added, removed, updated
@@ -0,0 +1,152 @@
+import atexit
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, TypeVar, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from playwright.sync_api import BrowserContext
+
+T = TypeVar('T')
+
+
+class BrowserPool:
+    # Playwright objects are bound to the thread that created them, so every browser lives in its own worker thread
+    # and logins are handed over to the workers. Each task gets a fresh BrowserContext that is closed afterwards.
+    def __init__(self, size: int = 2, max_uses: int = 20, idle_timeout: float = 300, headless: bool = True):
+        self.__size = size
+        self.__max_uses = max_uses
+        self.__idle_timeout = idle_timeout
+        self.__headless = headless
+        self.__tasks = queue.Queue()
+        self.__workers = []
+        self.__lock = threading.Lock()
+
+    def run(self, task: Callable[['BrowserContext'], T]) -> T:
+        future = Future()
+        with self.__lock:
+            # Workers that died are replaced
+            self.__workers = [worker for worker in self.__workers if worker.is_alive()]
+            for i in range(len(self.__workers), self.__size):
+                worker = threading.Thread(target=self.__work, name=f'browser-{i}', daemon=True)
+                self.__workers.append(worker)
+                worker.start()
+            self.__tasks.put((task, future))
+        return future.result()
+
+    def close(self):
+        with self.__lock:
+            workers = self.__workers
+            self.__workers = []
+            for _ in workers:
+                self.__tasks.put(None)
+        for worker in workers:
+            worker.join()
+
+    def __work(self):
+        try:
+            self.__serve()
+        except BaseException as e:
+            logging.error(f'Browser worker stopped: {e}', exc_info=e)
+            self.__abandon(e)
+
+    def __abandon(self, error: BaseException):
+        # Without a worker left, nobody would ever complete the queued logins, so they fail instead
+        with self.__lock:
+            current = threading.current_thread()
+            self.__workers = [worker for worker in self.__workers if worker is not current and worker.is_alive()]
+            if self.__workers:
+                return
+            stops = 0
+            while True:
+                try:
+                    item = self.__tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stops += 1
+                elif item[1].set_running_or_notify_cancel():
+                    item[1].set_exception(error)
+            # The stop signals belong to workers close() is waiting for
+            for _ in range(stops):
+                self.__tasks.put(None)
+
+    def __serve(self):
+        from playwright.sync_api import sync_playwright
+
+        playwright = None
+        browser = None
+        uses = 0
+        try:
+            while True:
+                try:
+                    item = self.__tasks.get(timeout=self.__idle_timeout)
+                except queue.Empty:
+                    # Give the memory back while nobody logs in
+                    if browser is not None:
+                        _close(browser, 'idle browser')
+                        browser = None
+                    continue
+                if item is None:
+                    break
+
+                task, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                try:
+                    if playwright is None:
+                        playwright = sync_playwright().start()
+                    if browser is None or uses >= self.__max_uses or not browser.is_connected():
+                        if browser is not None:
+                            logging.info(f'Recycling browser after {uses} logins')
+                            _close(browser, 'browser')
+                        browser = None
+                        browser = playwright.chromium.launch(headless=self.__headless)
+                        uses = 0
+                    uses += 1
+                    context = browser.new_context()
+                except BaseException as e:
+                    future.set_exception(e)
+                    continue
+
+                try:
+                    future.set_result(task(context))
+                except BaseException as e:
+                    future.set_exception(e)
+                finally:
+                    _close(context, 'browser context')
+        finally:
+            if browser is not None:
+                _close(browser, 'browser')
+            if playwright is not None:
+                try:
+                    playwright.stop()
+                except Exception as e:
+                    logging.warning(f'Failed to stop Playwright: {e}')
+
+
+def _close(resource, name: str):
+    # A browser that crashed may fail to close, which must not take its worker down
+    try:
+        resource.close()
+    except Exception as e:
+        logging.warning(f'Failed to close {name}: {e}')
+
+
+_default_pools: dict[bool, BrowserPool] = {}
+_default_pools_lock = threading.Lock()
+
+
+def default_pool(headless: bool = True) -> BrowserPool:
+    with _default_pools_lock:
+        if headless not in _default_pools:
+            _default_pools[headless] = BrowserPool(headless=headless)
+        return _default_pools[headless]
+
+
+@atexit.register
+def _close_default_pools():
+    for pool in _default_pools.values():
+        pool.close()
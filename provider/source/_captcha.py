@@ -0,0 +1,29 @@
+import threading
+
+from metrics import default_metrics
+
+# One OCR model per process, loaded on first use and shared by every provider and thread
+_model = None
+_model_lock = threading.Lock()
+
+
+def _get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                # Importing ddddocr pulls in onnxruntime, OpenCV and NumPy
+                with default_metrics.span('nuist.captcha_model_load'):
+                    import ddddocr as ocr
+                    _model = ocr.DdddOcr(show_ad=False)
+    return _model
+
+
+def classify(image: bytes) -> str:
+    model = _get_model()
+    with default_metrics.span('nuist.captcha'):
+        return model.classification(image)
+
+
+def is_captcha_error(message: str) -> bool:
+    return '验证码' in message or 'captcha' in message.lower()
@@ -0,0 +1,247 @@
+import base64
+import http.cookiejar
+import logging
+import random
+import threading
+from html.parser import HTMLParser
+from typing import TYPE_CHECKING
+from urllib.parse import urljoin
+
+from metrics import count_response_bytes
+from provider.source import _captcha
+from provider.source._browser_pool import BrowserPool, default_pool
+
+authserver_url = 'https://authserver.nuist.edu.cn'
+jwxt_url = 'http://jwxt.nuist.edu.cn'
+
+if TYPE_CHECKING:
+    import requests
+    from playwright.sync_api import BrowserContext
+
+user_agent = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:130.0) Gecko/20100101 Firefox/130.0'
+
+
+class LoginError(Exception):
+    pass
+
+
+class CredentialsError(LoginError):
+    # The authserver turned down the username or password, trying again (or with the browser) will not help
+    pass
+
+
+class SessionExpired(Exception):
+    # jwxt answered with the authserver (or any other page) instead of data, the session needs a new login
+    pass
+
+
+_local = threading.local()
+
+
+def _requests():
+    # requests is only imported once a request is made, so importing the providers stays cheap
+    import requests
+    return requests
+
+
+def request_error() -> type[Exception]:
+    return _requests().RequestException
+
+
+def transport() -> 'requests.Session':
+    # One keep-alive connection pool per thread, shared by the accounts the thread serves. It never stores cookies,
+    # every request brings the ones of its account.
+    session = getattr(_local, 'session', None)
+    if session is None:
+        session = count_response_bytes(_requests().Session(), 'nuist')
+        session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        session.headers['User-Agent'] = user_agent
+        _local.session = session
+    return session
+
+
+class _PageParser(HTMLParser):
+    # Collects the forms (with their inputs), the attributes of every element carrying an id
+    # and the text of the login error tip
+    def __init__(self):
+        super().__init__()
+        self.forms = []
+        self.elements = {}
+        self.error_tip = ''
+        self.__tip_tag = None
+        self.__tip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = {name: value or '' for name, value in attrs}
+        if 'id' in attrs:
+            self.elements[attrs['id']] = attrs
+        if tag == 'form':
+            self.forms.append({'attrs': attrs, 'inputs': []})
+        elif tag == 'input' and self.forms:
+            self.forms[-1]['inputs'].append(attrs)
+
+        if self.__tip_tag == tag:
+            self.__tip_depth += 1
+        elif self.__tip_tag is None and attrs.get('id') == 'showErrorTip':
+            self.error_tip += attrs.get('title', '')
+            self.__tip_tag = tag
+            self.__tip_depth = 1
+
+    def handle_endtag(self, tag):
+        if self.__tip_tag == tag:
+            self.__tip_depth -= 1
+            if self.__tip_depth == 0:
+                self.__tip_tag = None
+
+    def handle_data(self, data):
+        if self.__tip_tag is not None:
+            self.error_tip += data.strip()
+
+    def has_login_form(self) -> bool:
+        return any(any(i.get('id') == 'username' for i in f['inputs']) for f in self.forms)
+
+
+def _parse(html: str) -> _PageParser:
+    parser = _PageParser()
+    parser.feed(html)
+    return parser
+
+
+def _random_string(length: int) -> str:
+    charset = 'ABCDEFGHJKMNPQRSTWXYZabcdefhijkmnprstwxyz2345678'
+    return ''.join(random.choice(charset) for _ in range(length))
+
+
+def _encrypt_password(password: str, salt: str) -> str:
+    # Same as encryptPassword() in the authserver's encrypt.js: AES-CBC over 64 random chars + password
+    try:
+        from cryptography.hazmat.primitives import padding
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError as e:
+        raise LoginError('The login form wants an encrypted password, install cryptography for that') from e
+
+    padder = padding.PKCS7(128).padder()
+    data = padder.update((_random_string(64) + password).encode()) + padder.finalize()
+    encryptor = Cipher(algorithms.AES(salt.encode()), modes.CBC(_random_string(16).encode())).encryptor()
+    return base64.b64encode(encryptor.update(data) + encryptor.finalize()).decode()
+
+
+def _fill_login_form(session: 'requests.Session', page: _PageParser, login_url: str, username: str,
+                     password: str) -> tuple[str, dict]:
+    form = next((f for f in page.forms
+                 if any(i.get('id') == 'username' for i in f['inputs'])), None)
+    if form is None:
+        raise LoginError('No login form on the authserver page')
+
+    fields = {i['name']: i.get('value', '') for i in form['inputs']
+              if i.get('name') and i.get('type') not in ('button', 'submit', 'checkbox')}
+    named = {i['id']: i['name'] for i in form['inputs'] if i.get('id') and i.get('name')}
+
+    fields[named.get('username', 'username')] = username
+    if 'pwdEncryptSalt' in page.elements:
+        password = _encrypt_password(password, page.elements['pwdEncryptSalt']['value'])
+        fields[named.get('saltPassword', 'password')] = password
+    else:
+        fields[named.get('password', 'password')] = password
+
+    if 'captchaImg' in page.elements:
+        image = session.get(urljoin(login_url, page.elements['captchaImg']['src']), timeout=30)
+        fields[named.get('captcha', 'captcha')] = _captcha.classify(image.content)
+
+    return urljoin(login_url, form['attrs'].get('action', '')), fields
+
+
+def login_with_http(username: str, password: str, authserver: str = authserver_url, jwxt: str = jwxt_url,
+                    captcha_attempts: int = 3) -> list[dict]:
+    # The login needs a cookie jar of its own, only the connections are shared
+    session = count_response_bytes(_requests().Session(), 'nuist')
+    session.headers['User-Agent'] = user_agent
+    for prefix, adapter in transport().adapters.items():
+        session.mount(prefix, adapter)
+
+    # Authserver (CAS) login, every attempt gets a fresh form and captcha
+    login_url = f'{authserver}/authserver/login?type=userNameLogin'
+    for attempt in range(captcha_attempts):
+        response = session.get(login_url, timeout=30)
+        action, fields = _fill_login_form(session, _parse(response.text), response.url, username, password)
+        response = session.post(action, data=fields, timeout=30)
+        page = _parse(response.text)
+        if not page.has_login_form():
+            break
+        if not _captcha.is_captcha_error(page.error_tip):
+            raise CredentialsError(f'Authserver rejected the login {page.error_tip}'.strip())
+        logging.info(f'Captcha rejected (attempt {attempt + 1})')
+    else:
+        raise LoginError(f'Captcha rejected {captcha_attempts} times')
+
+    # Login course system through the tyrzBtn redirect
+    response = session.get(f'{jwxt}/jwapp/sys/yjsrzfwapp/dbLogin/main.do', timeout=30)
+    button = _parse(response.text).elements.get('tyrzBtn')
+    if button is None and not response.url.startswith(jwxt):
+        raise LoginError(f'Unexpected page while entering jwxt: {response.url}')
+    target = (button.get('href') or button.get('data-href')) if button else None
+    if not target or target.startswith(('#', 'javascript')):
+        target = f'{jwxt}/jwapp/sys/emaphome/portal/index.do?forceCas=1'
+    response = session.get(urljoin(response.url, target), timeout=30)
+    if not response.url.startswith(jwxt):
+        raise LoginError(f'CAS redirect ended outside jwxt: {response.url}')
+    session.get(f'{jwxt}/jwapp/sys/wdkb/*default/index.do?EMAP_LANG=zh', timeout=30)
+
+    logging.info('Logged in through plain HTTP')
+    return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path,
+             'expires': c.expires if c.expires else -1} for c in session.cookies]
+
+
+def login_with_browser(username: str, password: str, headless: bool = True, authserver: str = authserver_url,
+                       jwxt: str = jwxt_url, captcha_attempts: int = 3, pool: BrowserPool = None) -> list[dict]:
+    pool = pool if pool is not None else default_pool(headless)
+    return pool.run(lambda context: _browser_login(context, username, password, authserver, jwxt, captcha_attempts))
+
+
+def _browser_login(context: 'BrowserContext', username: str, password: str, authserver: str, jwxt: str,
+                   captcha_attempts: int) -> list[dict]:
+    page = context.new_page()
+    login_url = f"{authserver}/authserver/login?type=userNameLogin"
+    for attempt in range(captcha_attempts):
+        page.goto(login_url)
+        page.wait_for_load_state('load')
+
+        page.wait_for_selector('#username').fill(username)
+        page.wait_for_selector('#password').fill(password)
+
+        # Captcha
+        captcha_image = page.wait_for_selector('#captchaImg').screenshot()
+        page.wait_for_selector('#captcha').fill(_captcha.classify(captcha_image))
+
+        with page.expect_navigation():
+            page.wait_for_selector('#login_submit').click()
+        if not page.url.startswith(f'{authserver}/authserver/login'):
+            break
+
+        tip = page.query_selector('#showErrorTip')
+        message = tip.inner_text() if tip else ''
+        if not _captcha.is_captcha_error(message):
+            raise CredentialsError(f'Authserver rejected the login {message}'.strip())
+        logging.info(f'Captcha rejected (attempt {attempt + 1})')
+    else:
+        raise LoginError(f'Captcha rejected {captcha_attempts} times')
+
+    # Login course system
+    for _ in range(5):
+        if page.url.startswith(jwxt):
+            break
+        page.goto(
+            f"{jwxt}/jwapp/sys/yjsrzfwapp/dbLogin/main.do")
+        page.wait_for_load_state('load')
+    else:
+        raise LoginError(f'Could not reach jwxt, stuck at {page.url}')
+    page.wait_for_selector('#tyrzBtn').click()
+    page.wait_for_url(
+        f'{jwxt}/jwapp/sys/emaphome/portal/index.do?forceCas=1')
+    page.wait_for_load_state('load')
+    page.goto(
+        f'{jwxt}/jwapp/sys/wdkb/*default/index.do?EMAP_LANG=zh#/xskcb')
+    page.wait_for_load_state('load')
+
+    # Get cookie
+    return context.cookies()
@@ -0,0 +1,72 @@
+# Week sets are int bit sets, bit n set meaning the course takes place in week n.
+# A rule is (first week, interval, count, excluded weeks) and maps onto one WeeklyRecurrence.
+
+# What an EXDATE costs compared to one more event, a hole is worth excluding if it saves a whole event
+exdate_cost = 0.5
+
+
+def to_weeks(bits: int) -> list[int]:
+    weeks = []
+    week = 0
+    while bits:
+        if bits & 1:
+            weeks.append(week)
+        bits >>= 1
+        week += 1
+    return weeks
+
+
+def week_range(start: int, end: int, parity: int = None) -> int:
+    bits = 0
+    for week in range(start, end + 1):
+        if parity is None or week % 2 == parity:
+            bits |= 1 << week
+    return bits
+
+
+def _chains(weeks: list[int], interval: int) -> list[tuple[int, int, int, tuple]]:
+    # Maximal runs of weeks spaced by interval, weeks must be sorted
+    rules = []
+    pending = set(weeks)
+    for week in weeks:
+        if week not in pending:
+            continue
+        count = 0
+        while week + count * interval in pending:
+            pending.remove(week + count * interval)
+            count += 1
+        rules.append((week, interval if count > 1 else 1, count, ()))
+    return rules
+
+
+def _mixed(weeks: list[int]) -> list[tuple[int, int, int, tuple]]:
+    # Consecutive runs first, leftover single weeks chained every other week
+    runs = _chains(weeks, 1)
+    rules = [rule for rule in runs if rule[2] > 1]
+    singles = [rule[0] for rule in runs if rule[2] == 1]
+    return rules + _chains(singles, 2)
+
+
+def _excluding(weeks: list[int], interval: int) -> list[tuple[int, int, int, tuple]]:
+    first, last = weeks[0], weeks[-1]
+    if any((week - first) % interval for week in weeks):
+        return None
+    count = (last - first) // interval + 1
+    taken = set(weeks)
+    excluded = tuple(first + i * interval for i in range(count) if first + i * interval not in taken)
+    return [(first, interval if count > 1 else 1, count, excluded)]
+
+
+def _cost(rules: list[tuple[int, int, int, tuple]]) -> tuple:
+    exdates = sum(len(rule[3]) for rule in rules)
+    return len(rules) + exdate_cost * exdates, exdates, len(rules)
+
+
+def compile_weeks(bits: int) -> list[tuple[int, int, int, tuple]]:
+    # Picks the cheapest exact cover of the week set among plain runs and single rules with exclusions
+    weeks = to_weeks(bits)
+    if not weeks:
+        return []
+
+    candidates = [_chains(weeks, 1), _chains(weeks, 2), _mixed(weeks), _excluding(weeks, 1), _excluding(weeks, 2)]
+    return sorted(min((c for c in candidates if c is not None), key=_cost))
@@ -1,41 +1,63 @@
 import datetime
+import hashlib
 from argparse import ArgumentError
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Course:
     name: str
     location: str
     recurrence: 'Recurrence'
     start_date: datetime.datetime
     end_date: datetime.datetime
+    # Where the course came from, not part of what makes two courses equal
+    semester: str = field(default=None, compare=False)
+    _hash: int = field(init=False, repr=False, compare=False)
+    _fingerprint: str = field(init=False, repr=False, compare=False, default=None)
+
+    def __post_init__(self):
+        object.__setattr__(self, '_hash',
+                           hash((self.name, self.location, self.recurrence, self.start_date, self.end_date)))
 
     def __hash__(self):
-        h = hash(self.name) * 31
-        h += hash(self.location) * 31
-        h += hash(self.recurrence) * 31
-        h += hash(self.start_date) * 31
-        h += hash(self.end_date) * 31
-        return h
+        return self._hash
 
     def __eq__(self, other):
-        return isinstance(other, self.__class__) and \
+        return isinstance(other, self.__class__) and self._hash == other._hash and \
             self.name == other.name and self.location == other.location and \
             self.recurrence == other.recurrence and self.start_date == other.start_date \
             and self.end_date == other.end_date
 
+    def __reduce__(self):
+        # hash() of a str differs between processes, so the cached hash must not be pickled
+        return self.__class__, (self.name, self.location, self.recurrence, self.start_date, self.end_date, self.semester)
+
+    @property
+    def fingerprint(self) -> str:
+        # Digest of the normalised fields, stable across runs and processes unlike hash()
+        if self._fingerprint is None:
+            recurrence = self.recurrence.to_ical_presentation() if self.recurrence else ''
+            content = '\x1f'.join((self.name, self.location or '', self.start_date.isoformat(),
+                                    self.end_date.isoformat(), recurrence))
+            object.__setattr__(self, '_fingerprint', hashlib.sha1(content.encode()).hexdigest())
+        return self._fingerprint
+
 
 class Recurrence:
-    def to_ical_presentation(self) -> str:
+    __slots__ = ()
+
+    def to_ical_presentation(self, tzid: str = None) -> str:
         pass
 
     @staticmethod
     def from_ical_presentation(ical_presentation: str) -> 'Recurrence':
-        if not ical_presentation.startswith('RRULE:'):
+        # One property per line: an RRULE, optionally along with EXDATE lines
+        rules = [line for line in ical_presentation.splitlines() if line.startswith('RRULE:')]
+        if len(rules) != 1:
             raise ArgumentError(message=f'Invalid ical presentation "{ical_presentation}"', argument=None)
 
-        arguments = ical_presentation[len('RRULE:'):].split(';')
+        arguments = rules[0][len('RRULE:'):].split(';')
         freq = ''
         count = ''
         interval = '1'
@@ -51,27 +73,43 @@ class Recurrence:
         if not freq or not count:
             raise ArgumentError(message=f'Ical "{ical_presentation}" is missing parameters', argument=None)
 
+        exdates = []
+        for line in ical_presentation.splitlines():
+            if line.startswith('RRULE:'):
+                continue
+            if not line.startswith(('EXDATE:', 'EXDATE;')):
+                raise ArgumentError(message=f'Unsupported ical property "{line}"', argument=None)
+            # EXDATE:20240909T080000 or EXDATE;TZID=Asia/Shanghai:20240909T080000,20240916T080000
+            for value in line.rsplit(':', 1)[1].split(','):
+                exdates.append(datetime.datetime.strptime(value.rstrip('Z'), '%Y%m%dT%H%M%S'))
+
         if freq == 'WEEKLY':
-            return WeeklyRecurrence(interval=int(interval), count=int(count))
+            return WeeklyRecurrence(interval=int(interval), count=int(count), exdates=tuple(sorted(exdates)))
         else:
             raise NotImplementedError(f'Unsupported frequency "{freq}"')
 
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class WeeklyRecurrence(Recurrence):
     interval: int
     count: int
+    exdates: tuple[datetime.datetime, ...] = ()
 
-    def __hash__(self):
-        return self.interval * 31 + self.count
-
-    def to_ical_presentation(self) -> str:
-        return f'RRULE:FREQ=WEEKLY;COUNT={self.count};INTERVAL={self.interval}'
+    def to_ical_presentation(self, tzid: str = None) -> str:
+        rule = f'RRULE:FREQ=WEEKLY;COUNT={self.count};INTERVAL={self.interval}'
+        if not self.exdates:
+            return rule
+        exdate = 'EXDATE' if tzid is None else f'EXDATE;TZID={tzid}'
+        return f'{rule}\n{exdate}:{','.join(d.strftime('%Y%m%dT%H%M%S') for d in self.exdates)}'
 
 
 class SourceProvider:
     def __init__(self):
+        # Set by get_courses() of providers that can tell the courses didn't change since mark_synced()
+        self.unchanged = False
+
+    def mark_synced(self):
         pass
 
     def get_courses(self) -> set[Course]:
@@ -1,46 +1,105 @@
+import json
 import logging
-from datetime import datetime
+import re
+from datetime import datetime, timedelta
 
-from provider._google import GoogleProvider, AuthorizationException, google_event_to_course, RetryException
+import cache
+from provider._google import GoogleProvider, AuthorizationException, google_event_to_course, RequestExecutor, \
+    http_error
 from provider.source.base import SourceProvider, Course
 
+# The only parts of an event google_event_to_course() reads, the snapshot keeps nothing else
+_event_keys = ('id', 'summary', 'location', 'start', 'end', 'recurrence')
+
 
 class GoogleSourceProvider(SourceProvider, GoogleProvider):
 
     def __init__(self, first_school_day: datetime, calendar_id: str = 'primary',
                  credentials_file: str = './cache/google_credentials.json',
                  token_file: str = 'google_token.json', callback_addr: str = 'localhost', callback_port: int = 24849,
-                 api_key: str = None):
+                 api_key: str = None, incremental: bool = False, executor: RequestExecutor = None,
+                 last_school_day: datetime = None, lean_listing: bool = True, cache_responses: bool = True,
+                 api_endpoint: str = None):
         SourceProvider.__init__(self)
         GoogleProvider.__init__(self, calendar_id, credentials_file, token_file, callback_addr, callback_port,
-                                api_key)
+                                api_key, executor=executor, lean_listing=lean_listing,
+                                cache_responses=cache_responses, api_endpoint=api_endpoint)
         self.__first_school_day = first_school_day
+        # No semester is longer than half a year
+        self.__last_school_day = last_school_day if last_school_day is not None else \
+            first_school_day + timedelta(weeks=26)
+        self.__incremental = incremental
 
     def get_courses(self) -> set[Course]:
         try:
             self._login_or_fail()
-        except RetryException:
-            return self.get_courses()
         except AuthorizationException as e:
             logging.error(e.message, exc_info=e.base_exception)
             return set()
 
+        if self.__incremental:
+            return self.__get_courses_incremental()
+
         time_min = self.__first_school_day.replace(
             tzinfo=self._calendar_tz()) if self.__first_school_day.tzinfo is None else self.__first_school_day
+        time_max = self.__last_school_day.replace(
+            tzinfo=self._calendar_tz()) if self.__last_school_day.tzinfo is None else self.__last_school_day
+
+        result = set()
+        for e in self._list_events(timeMin=time_min.isoformat(), timeMax=time_max.isoformat()):
+            if 'summary' in e:
+                result.add(google_event_to_course(e))
+
+        return result
+
+    def __get_courses_incremental(self) -> set[Course]:
+        # syncToken can't be combined with timeMin, so the snapshot covers the whole calendar and is filtered here
+        first_school_day = self.__first_school_day.replace(tzinfo=None)
 
         result = set()
-        page_token = None
-        while True:
-            events = self._service.events().list(calendarId=self._calendar_id,
-                                             timeMin=time_min.isoformat(),
-                                             pageToken=page_token).execute()
-            for e in events['items']:
-                if 'summary' in e:
-                    result.add(google_event_to_course(e))
-
-            if 'nextPageToken' in events:
-                page_token = events['nextPageToken']
-            else:
-                break
-
-        return result
\ No newline at end of file
+        for e in self.__sync_events().values():
+            if 'summary' not in e or 'dateTime' not in e['end']:
+                continue
+            if datetime.fromisoformat(e['end']['dateTime']).replace(tzinfo=None) > first_school_day:
+                result.add(google_event_to_course(e))
+
+        return result
+
+    def __snapshot_file(self) -> str:
+        return f'google_sync_{self._account()}_{re.sub(r'[^\w.@-]', '_', self._calendar_id)}.json'
+
+    def __sync_events(self) -> dict[str, dict]:
+        snapshot = None
+        if cache.exists(self.__snapshot_file()):
+            with cache.open_cache(self.__snapshot_file(), 'r') as f:
+                snapshot = json.load(f)
+
+        if snapshot is not None:
+            try:
+                events, sync_token = self.__fetch_events(snapshot['events'], syncToken=snapshot['sync_token'])
+                logging.info('Calendar synchronized incrementally')
+            except http_error() as e:
+                if e.resp.status != 410:
+                    raise
+                logging.info('Sync token expired, doing a full synchronization')
+                snapshot = None
+
+        if snapshot is None:
+            events, sync_token = self.__fetch_events({})
+
+        cache.write_atomic(self.__snapshot_file(), json.dumps({'sync_token': sync_token, 'events': events}))
+
+        return events
+
+    def __fetch_events(self, events: dict[str, dict], **kwargs) -> tuple[dict[str, dict], str]:
+        events = dict(events)
+        sync_token = None
+        for page in self._list_pages(showDeleted=True, **kwargs):
+            for e in page['items']:
+                if e.get('status') == 'cancelled':
+                    events.pop(e['id'], None)
+                else:
+                    events[e['id']] = {key: e[key] for key in _event_keys if key in e}
+            sync_token = page.get('nextSyncToken', sync_token)
+
+        return events, sync_token
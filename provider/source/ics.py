@@ -0,0 +1,25 @@
+import logging
+import os
+
+from metrics import default_metrics
+from provider import _ics
+from provider.source.base import SourceProvider, Course
+
+
+class ICSSourceProvider(SourceProvider):
+    # Reads the courses back from an iCalendar file, e.g. one written by ICSDestinationProvider
+    def __init__(self, file: str, tzid: str = 'Asia/Shanghai'):
+        super().__init__()
+        self.__file = file
+        self.__tzid = tzid
+
+    def iter_courses(self):
+        if not os.path.exists(self.__file):
+            return
+        yield from _ics.read_courses(self.__file, self.__tzid)
+
+    def get_courses(self) -> set[Course]:
+        with default_metrics.span('ics.read'):
+            courses = set(self.iter_courses())
+        logging.info(f'Read {len(courses)} courses from {self.__file}')
+        return courses
@@ -1,11 +1,17 @@
 import datetime
+import hashlib
+import json
 import logging
-import math
-
-import ddddocr as ocr
-import requests
-from playwright.sync_api import sync_playwright
+import pickle
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, Mapping
 
+import cache
+from metrics import default_metrics
+from provider.source import _nuist, _weeks
+from provider.source._browser_pool import BrowserPool
 from provider.source.base import SourceProvider, Course, WeeklyRecurrence
 
 default_class_timetable = [
@@ -21,63 +27,160 @@ default_class_timetable = [
     19 * 60 * 60 + 40 * 60,
     20 * 60 * 60 + 35 * 60]  # in seconds
 
+_weekdays = {'星期一': 0, '星期二': 1, '星期三': 2, '星期四': 3, '星期五': 4, '星期六': 5, '星期日': 6}
+
+# ZCMC lists week ranges such as 1-15周(单), 1,2,3周 or 1-8周,10-16周(双)
+_week_pattern = re.compile(r'(\d+)(?:-(\d+))?周?(?:\((单|双)\))?')
+# KSJC_DISPLAY and JSJC_DISPLAY name a section such as 第3节
+_section_pattern = re.compile(r'(\d+)')
+
+# jwxt is asked for at most this many semesters at once
+max_concurrent_semesters = 4
+# Long-lived, so its threads keep their transports (and keep-alive connections) from one get_courses() to the next
+_fetch_pool = ThreadPoolExecutor(max_workers=max_concurrent_semesters, thread_name_prefix='nuist')
+
+
+def _parse_weeks(text: str) -> int:
+    weeks = 0
+    for match in _week_pattern.finditer(text):
+        start_week = int(match[1])
+        end_week = int(match[2]) if match[2] else start_week
+        parity = {'单': 1, '双': 0}.get(match[3])
+        weeks |= _weeks.week_range(start_week, end_week, parity)
+    return weeks
+
+
+def _parse_section(text: str) -> int:
+    return int(_section_pattern.search(text)[1])
+
+
+def _slots(rows: Iterable[dict]) -> Iterator[tuple[tuple, int]]:
+    # (name, location, weekday, first section, last section) and the week set of every row
+    for row in rows:
+        yield ((row['KCM'], row['JASMC'], _weekdays[row['SKXQ_DISPLAY']], _parse_section(row['KSJC_DISPLAY']),
+                _parse_section(row['JSJC_DISPLAY'])), _parse_weeks(row['ZCMC']))
+
+
+def _merged(slots: Iterable[tuple[tuple, int]]) -> Iterator[tuple[tuple, int]]:
+    # All weeks of one course in one slot are collected first, then compiled into as few events as possible
+    week_sets: dict[tuple, int] = {}
+    for key, weeks in slots:
+        week_sets[key] = week_sets.get(key, 0) | weeks
+    yield from week_sets.items()
+
+
+def _rules(merged: Iterable[tuple[tuple, int]]) -> Iterator[tuple[tuple, tuple]]:
+    for key, weeks in merged:
+        for rule in _weeks.compile_weeks(weeks):
+            yield key, rule
+
 
 class NUISTSourceProvider(SourceProvider):
-    def __init__(self, username: str, password: str, first_school_day: datetime.datetime, semester: str, headless=True,
-                 class_timetable=default_class_timetable):
+    def __init__(self, username: str, password: str,
+                 first_school_day: datetime.datetime | Mapping[str, datetime.datetime],
+                 semester: str | Iterable[str], headless=True,
+                 class_timetable=default_class_timetable, session_ttl: int = 6 * 60 * 60, login_engine: str = 'http',
+                 authserver_url: str = _nuist.authserver_url, jwxt_url: str = _nuist.jwxt_url,
+                 captcha_attempts: int = 3, browser_pool: BrowserPool = None, timetable_ttl: float = 0):
         self.__username = username
         self.__password = password
         self.__headless = headless
-        self.__semester = semester
+        # Several semesters need first_school_day as a mapping from semester to its first day
+        self.__semesters = (semester,) if isinstance(semester, str) else tuple(sorted(set(semester)))
         self.__first_school_day = first_school_day
         self.__class_timetable = class_timetable
+        self.__session_ttl = session_ttl
+        self.__login_engine = login_engine
+        self.__authserver_url = authserver_url
+        self.__jwxt_url = jwxt_url
+        self.__captcha_attempts = captcha_attempts
+        self.__browser_pool = browser_pool
+        self.__timetable_ttl = timetable_ttl
         self.__cookies = None
+        self.__hashes = {}
+        self.__parsed = {}
         super().__init__()
 
+    def __session_file(self) -> str:
+        return f'nuist_session_{self.__username}.json'
+
+    def __load_session(self) -> bool:
+        file = self.__session_file()
+        if not cache.exists(file):
+            return False
+
+        with cache.open_cache(file, 'r') as f:
+            session = json.load(f)
+
+        if session['expires'] <= time.time() or not self.__probe_session(session['cookies']):
+            logging.info('Cached NUIST session expired')
+            cache.remove(file)
+            return False
+
+        self.__cookies = session['cookies']
+        default_metrics.count('nuist.sessions_reused')
+        logging.info('Reusing cached NUIST session')
+        return True
+
+    def __save_session(self):
+        expires = [cookie['expires'] for cookie in self.__cookies
+                   if 'jwxt' in cookie.get('domain', '') and cookie.get('expires', -1) > 0]
+        session = {
+            'expires': min(expires + [time.time() + self.__session_ttl]),
+            'cookies': self.__cookies,
+        }
+        with cache.open_cache(self.__session_file(), 'w') as f:
+            json.dump(session, f)
+
+    def __probe_session(self, cookies: list[dict]) -> bool:
+        # An expired session gets redirected to the authserver instead of serving the page
+        try:
+            response = _nuist.transport().get(f'{self.__jwxt_url}/jwapp/sys/wdkb/*default/index.do',
+                                              cookies={cookie['name']: cookie['value'] for cookie in cookies},
+                                              allow_redirects=False, timeout=10)
+        except _nuist.request_error():
+            return False
+        return response.status_code == 200
+
+    @default_metrics.timed('nuist.login')
     def __get_cookies(self):
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=self.__headless)
-            page = browser.new_page()
-            page.goto(
-                "https://authserver.nuist.edu.cn/authserver/login?type=userNameLogin")
-            page.wait_for_load_state('load')
-
-            page.wait_for_selector('#username').fill(self.__username)
-            page.wait_for_selector('#password').fill(self.__password)
-
-            # Captcha
-            captcha_image = page.wait_for_selector('#captchaImg').screenshot()
-            model = ocr.DdddOcr(show_ad=False)
-            captcha = model.classification(captcha_image)
-            page.wait_for_selector('#captcha').fill(captcha)
-
-            page.wait_for_selector('#login_submit').click()
-
-            # Login course system
-            while not page.url.startswith('http://jwxt'):
-                page.goto(
-                    "http://jwxt.nuist.edu.cn/jwapp/sys/yjsrzfwapp/dbLogin/main.do")
-                page.wait_for_load_state('load')
-            page.wait_for_selector('#tyrzBtn').click()
-            page.wait_for_url(
-                'http://jwxt.nuist.edu.cn/jwapp/sys/emaphome/portal/index.do?forceCas=1')
-            page.wait_for_load_state('load')
-            page.goto(
-                'http://jwxt.nuist.edu.cn/jwapp/sys/wdkb/*default/index.do?EMAP_LANG=zh#/xskcb')
-            page.wait_for_load_state('load')
-
-            # Get cookie
-            cookies = page.context.cookies()
-            self.__cookies = cookies
-            browser.close()
+        self.__cookies = None
+        if self.__login_engine == 'http':
+            try:
+                with default_metrics.span('nuist.login_http'):
+                    self.__cookies = _nuist.login_with_http(self.__username, self.__password, self.__authserver_url,
+                                                            self.__jwxt_url, self.__captcha_attempts)
+            except _nuist.CredentialsError:
+                # Submitting a wrong password once more would only bring the account closer to a lockout
+                raise
+            except (_nuist.LoginError, _nuist.request_error()) as e:
+                default_metrics.count('nuist.login_http_failures')
+                logging.warning(f'HTTP login failed, falling back to the browser: {e}')
 
+        if self.__cookies is None:
+            with default_metrics.span('nuist.login_browser'):
+                self.__cookies = _nuist.login_with_browser(self.__username, self.__password, self.__headless,
+                                                           self.__authserver_url, self.__jwxt_url,
+                                                           self.__captcha_attempts, self.__browser_pool)
+
+        self.__save_session()
         logging.info("Got sweet cookie, u want one?")
         return
 
-    def __create_course(self, name: str, location: str, start_week: int, end_week: int, start_time: int, end_time: int,
-                        weekday: int, duration_type: str) -> Course:
-        start_date = self.__first_school_day + \
-                     datetime.timedelta(days=(start_week - 1) * 7 + weekday)
+    def __first_day(self, semester: str, semesters: tuple[str, ...]) -> datetime.datetime:
+        if isinstance(self.__first_school_day, datetime.datetime):
+            if len(semesters) > 1:
+                raise ValueError('Fetching several semesters needs first_school_day as a mapping by semester')
+            return self.__first_school_day
+        if semester not in self.__first_school_day:
+            raise ValueError(f'No first school day for semester {semester}')
+        return self.__first_school_day[semester]
+
+    def __create_course(self, name: str, location: str, first_week: int, interval: int, count: int,
+                        excluded_weeks: tuple, start_time: int, end_time: int, weekday: int,
+                        first_school_day: datetime.datetime, semester: str) -> Course:
+        start_date = first_school_day + \
+                     datetime.timedelta(days=(first_week - 1) * 7 + weekday)
 
         start_time = self.__class_timetable[start_time - 1]
         end_time = self.__class_timetable[end_time - 1]
@@ -90,10 +193,9 @@ class NUISTSourceProvider(SourceProvider):
             hour=end_time // 3600, minute=(end_time % 3600) // 60, second=end_time % 60)
 
         recurrence = None
-        if start_week != end_week:
-            interval = 1 if duration_type == 'normal' else 2
-            count = math.ceil((end_week - start_week + 1) / interval)
-            recurrence = WeeklyRecurrence(interval, count)
+        if count > 1:
+            exdates = tuple(start_date + datetime.timedelta(weeks=week - first_week) for week in excluded_weeks)
+            recurrence = WeeklyRecurrence(interval, count, exdates)
 
         return Course(
             name=name,
@@ -101,71 +203,170 @@ class NUISTSourceProvider(SourceProvider):
             recurrence=recurrence,
             start_date=start_date,
             end_date=end_date,
+            semester=semester,
         )
 
-    def get_courses(self) -> set[Course]:
-        if self.__cookies is None:
-            self.__get_cookies()
+    def __timetable_file(self, semester: str) -> str:
+        return f'nuist_timetable_{self.__username}_{semester}.json'
+
+    def __load_timetable(self, semester: str) -> dict:
+        if not cache.exists(self.__timetable_file(semester)):
+            return None
+        with cache.open_cache(self.__timetable_file(semester), 'r') as f:
+            return json.load(f)
+
+    def __save_timetable(self, semester: str, snapshot: dict):
+        with cache.open_cache(self.__timetable_file(semester), 'w') as f:
+            json.dump(snapshot, f)
+
+    def __courses_file(self, semester: str) -> str:
+        return f'nuist_courses_{self.__username}_{semester}.pickle'
+
+    def __load_courses(self, semester: str, content_hash: str) -> frozenset[Course]:
+        # The courses parsed from a timetable are kept next to its snapshot, a later run with the same timetable
+        # neither decodes nor parses it again
+        if not cache.exists(self.__courses_file(semester)):
+            return None
+        try:
+            with cache.open_cache(self.__courses_file(semester), 'rb') as f:
+                stored_hash, courses = pickle.load(f)
+        except (pickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError) as e:
+            logging.warning(f'Dropping unreadable parsed NUIST timetable: {e}')
+            return None
+        return courses if stored_hash == content_hash else None
+
+    def __save_courses(self, semester: str, content_hash: str, courses: frozenset[Course]):
+        with cache.open_cache(self.__courses_file(semester), 'wb') as f:
+            pickle.dump((content_hash, courses), f)
+
+    def __content_hash(self, payload: str, first_school_day: datetime.datetime) -> str:
+        # The courses also depend on the first school day and the timetable, a change of either is a change as well
+        content = '\x1f'.join((payload, first_school_day.isoformat(), repr(self.__class_timetable)))
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get_courses(self, max_age: float = None, semesters: str | Iterable[str] = None) -> set[Course]:
+        # A timetable snapshot younger than max_age (defaults to timetable_ttl) is used without contacting jwxt.
+        # Several semesters are fetched at once over one login and merged into one set.
+        if semesters is None:
+            semesters = self.__semesters
+        elif isinstance(semesters, str):
+            semesters = (semesters,)
+        else:
+            semesters = tuple(sorted(set(semesters)))
+        first_days = {semester: self.__first_day(semester, semesters) for semester in semesters}
+        max_age = self.__timetable_ttl if max_age is None else max_age
+
+        snapshots = {semester: self.__load_timetable(semester) for semester in semesters}
+        stale = [semester for semester, snapshot in snapshots.items()
+                 if snapshot is None or not 0 <= time.time() - snapshot['fetched'] < max_age]
+        if len(stale) < len(semesters):
+            default_metrics.count('nuist.timetable_cache_hits', len(semesters) - len(stale))
+            logging.info('Using cached NUIST timetable')
+
+        if stale:
+            payloads = self.__fetch_timetables(stale)
+
+            for semester, payload in payloads.items():
+                previous = snapshots[semester]
+                snapshots[semester] = {
+                    'fetched': time.time(),
+                    'hash': self.__content_hash(payload, first_days[semester]),
+                    'synced_hash': previous.get('synced_hash') if previous is not None else None,
+                    'payload': payload,
+                }
+                self.__save_timetable(semester, snapshots[semester])
+
+        self.__hashes = {semester: snapshot['hash'] for semester, snapshot in snapshots.items()}
+        self.unchanged = all(snapshot['hash'] == snapshot['synced_hash'] for snapshot in snapshots.values())
+        if self.unchanged:
+            logging.info('NUIST timetable unchanged since the last sync')
 
         courses = set()
+        for semester, snapshot in snapshots.items():
+            parsed = self.__parsed.get(semester)
+            if parsed is None or parsed[0] != snapshot['hash']:
+                semester_courses = self.__load_courses(semester, snapshot['hash'])
+                if semester_courses is None:
+                    table = json.loads(snapshot['payload'])['datas']['cxxszhxqkb']['rows']
+                    semester_courses = frozenset(self.__parse_timetable(table, first_days[semester], semester))
+                    self.__save_courses(semester, snapshot['hash'], semester_courses)
+                parsed = self.__parsed[semester] = (snapshot['hash'], semester_courses)
+            courses |= parsed[1]
 
+        logging.info(f"Fetched {len(courses)} courses")
+        return courses
+
+    def mark_synced(self):
+        # Remembers the timetables of the last get_courses() as synchronized, equal ones are reported as unchanged
+        snapshots = {semester: self.__load_timetable(semester) for semester in self.__hashes}
+        if any(snapshot is None or snapshot['hash'] != self.__hashes[semester]
+               for semester, snapshot in snapshots.items()):
+            return
+        for semester, snapshot in snapshots.items():
+            snapshot['synced_hash'] = snapshot['hash']
+            self.__save_timetable(semester, snapshot)
+        self.unchanged = True
+
+    def __fetch_timetables(self, semesters: list[str]) -> dict[str, str]:
+        # A session that expired while in use is dropped and replaced by a new login, once
+        for attempt in range(2):
+            if self.__cookies is None and not self.__load_session():
+                self.__get_cookies()
+            try:
+                # A single semester is fetched right here, over the connection the login just used
+                if len(semesters) == 1:
+                    return {semesters[0]: self.__fetch_timetable(semesters[0])}
+                return dict(zip(semesters, _fetch_pool.map(self.__fetch_timetable, semesters)))
+            except _nuist.SessionExpired as e:
+                if attempt > 0:
+                    raise
+                logging.info(f'NUIST session expired, logging in again: {e}')
+                default_metrics.count('nuist.sessions_expired')
+                self.__cookies = None
+                if cache.exists(self.__session_file()):
+                    cache.remove(self.__session_file())
+
+    def __fetch_timetable(self, semester: str) -> str:
         headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:130.0) Gecko/20100101 Firefox/130.0',
+            'User-Agent': _nuist.user_agent,
             'Accept': 'application/json, text/javascript, */*; q=0.01',
             'Accept-Language': 'zh-CN,en-US;q=0.7,en;q=0.3',
             'Accept-Encoding': 'gzip, deflate',
             'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
             'X-Requested-With': 'XMLHttpRequest',
-            'Origin': 'http://jwxt.nuist.edu.cn',
+            'Origin': self.__jwxt_url,
             'DNT': '1',
             'Sec-GPC': '1',
             'Connection': 'keep-alive',
-            'Referer': 'http://jwxt.nuist.edu.cn/jwapp/sys/wdkb/*default/index.do?EMAP_LANG=zh'
+            'Referer': f'{self.__jwxt_url}/jwapp/sys/wdkb/*default/index.do?EMAP_LANG=zh'
         }
 
-        response = requests.post(
-            'http://jwxt.nuist.edu.cn/jwapp/sys/wdkb/modules/xskcb/cxxszhxqkb.do',
-            cookies={cookie['name']: cookie['value']
-                     for cookie in self.__cookies},
-            headers=headers,
-            data=f'XNXQDM={self.__semester}'
-            # data=f'XNXQDM=2024-2025-1'
-        ).json()
-
-        table = response['datas']['cxxszhxqkb']['rows']
-        weekdays = ['星期一', '星期二', '星期三', '星期四', '星期五', '星期六', '星期日']
-
-        for c in table:
-            name = c['KCM']
-            location = c['JASMC']
-            duration = c['ZCMC']  # 1-15周(单) / 1,2,3周
-            weekday = c['SKXQ_DISPLAY']  # 星期x
-            start_time = int(c['KSJC_DISPLAY'].replace(
-                '第', '').replace('节', ''))
-            end_time = int(c['JSJC_DISPLAY'].replace('第', '').replace('节', ''))
-
-            # parse weekday to number
-            weekday = weekdays.index(weekday)
-
-
-            l = duration.split(',')
-            for component in l:
-                duration_type = 'normal'
-                # parse duration to start and end week
-                if '单' in component:
-                    duration_type = 'odd'
-                    component = component.replace('(单)', '')
-                elif '双' in component:
-                    duration_type = 'even'
-                    component = component.replace('(双)', '')
-
-                span = component.replace('周', '').split('-')
-                start_week = int(span[0])
-                end_week = int(span[1]) if len(span) > 1 else start_week
-
-                course = self.__create_course(name, location, start_week, end_week, start_time, end_time, weekday,
-                                              duration_type)
-                courses.add(course)
+        with default_metrics.span('nuist.fetch'):
+            response = _nuist.transport().post(
+                f'{self.__jwxt_url}/jwapp/sys/wdkb/modules/xskcb/cxxszhxqkb.do',
+                cookies={cookie['name']: cookie['value']
+                         for cookie in self.__cookies},
+                headers=headers,
+                allow_redirects=False,
+                data=f'XNXQDM={semester}'
+                # data=f'XNXQDM=2024-2025-1'
+            )
+        # An expired session is sent to the authserver, or gets its login page right away
+        if response.is_redirect:
+            raise _nuist.SessionExpired(f'jwxt redirected to {response.headers.get('Location')}')
+        response.raise_for_status()
+        try:
+            data = response.json()
+        except ValueError:
+            raise _nuist.SessionExpired(f'jwxt answered with a page instead of JSON: {response.text[:200]}')
+        # Anything else but a timetable must not end up in the snapshot either
+        if 'rows' not in data['datas']['cxxszhxqkb']:
+            raise ValueError(f'Unexpected jwxt response: {response.text[:200]}')
+        return response.text
 
-        logging.info(f"Fetched {len(courses)} courses")
-        return courses
+    @default_metrics.timed('nuist.parse')
+    def __parse_timetable(self, rows: list[dict], first_school_day: datetime.datetime, semester: str) -> set[Course]:
+        return {self.__create_course(name, location, first_week, interval, count, excluded_weeks,
+                                     start_time, end_time, weekday, first_school_day, semester)
+                for (name, location, weekday, start_time, end_time), (first_week, interval, count, excluded_weeks)
+                in _rules(_merged(_slots(rows)))}
@@ -0,0 +1,118 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+
+import planner
+from metrics import default_metrics
+from provider._google import default_executor
+from provider.destination.base import DestinationProvider
+from provider.source.base import SourceProvider
+
+# Concurrent calls allowed per provider class, logins are expensive while API calls are cheap
+default_limits = {
+    'NUISTSourceProvider': 2,
+    'GoogleSourceProvider': 8,
+    'GoogleDestinationProvider': 8,
+}
+
+
+@dataclass
+class SyncJob:
+    # Providers are built by the worker running the job, so no provider (and no httplib2 object) is shared by threads
+    name: str
+    source: Callable[[], SourceProvider]
+    reference: Callable[[], SourceProvider]
+    destination: Callable[[], DestinationProvider]
+
+
+@dataclass
+class SyncSummary:
+    name: str
+    added: int = 0
+    removed: int = 0
+    updated: int = 0
+    elapsed: float = 0
+    error: Exception = None
+
+    def __str__(self):
+        if self.error is not None:
+            return f'{self.name}: failed after {self.elapsed:.1f}s ({self.error})'
+        return f'{self.name}: +{self.added} -{self.removed} ~{self.updated} in {self.elapsed:.1f}s'
+
+
+class SyncEngine:
+    def __init__(self, max_workers: int = 8, limits: dict[str, int] = None, dry_run: bool = False,
+                 metrics_file: str = None, textfile: str = None):
+        self.__max_workers = max_workers
+        self.__metrics_file = metrics_file
+        self.__textfile = textfile
+        self.__limits = {name: threading.Semaphore(limit)
+                         for name, limit in (limits if limits is not None else default_limits).items()}
+        self.__dry_run = dry_run
+
+    @contextmanager
+    def __limited(self, provider):
+        semaphore = self.__limits.get(type(provider).__name__)
+        if semaphore is None:
+            yield
+            return
+        with semaphore:
+            yield
+
+    def run(self, jobs: list[SyncJob]) -> list[SyncSummary]:
+        with ThreadPoolExecutor(max_workers=self.__max_workers, thread_name_prefix='sync') as pool:
+            summaries = list(pool.map(self.__run_job, jobs))
+
+        for summary in summaries:
+            logging.info(str(summary))
+        logging.info(f'Google calendar usage: {default_executor.usage}')
+
+        default_metrics.count('sync.jobs', len(summaries))
+        default_metrics.count('sync.failed_jobs', sum(summary.error is not None for summary in summaries))
+        logging.info(f'Metrics: {default_metrics}')
+        if self.__metrics_file:
+            default_metrics.write_json(self.__metrics_file)
+        if self.__textfile:
+            default_metrics.write_prometheus(self.__textfile)
+        return summaries
+
+    def __run_job(self, job: SyncJob) -> SyncSummary:
+        summary = SyncSummary(job.name)
+        start = time.perf_counter()
+        try:
+            source = job.source()
+            with self.__limited(source):
+                new_courses = source.get_courses()
+            if source.unchanged:
+                # Nothing changed since the last successful sync, the calendar doesn't need a look
+                default_metrics.count('sync.unchanged_jobs')
+                summary.elapsed = time.perf_counter() - start
+                return summary
+
+            reference = job.reference()
+            with self.__limited(reference):
+                old_courses = reference.get_courses()
+
+            with default_metrics.span('sync.plan'):
+                plan = planner.plan(old_courses, new_courses)
+            if self.__dry_run:
+                summary.added, summary.removed, summary.updated = len(plan.inserts), len(plan.deletes), len(plan.updates)
+            else:
+                if plan:
+                    destination = job.destination()
+                    with self.__limited(destination):
+                        added, removed, updated = destination.apply_plan(plan)
+                    summary.added, summary.removed, summary.updated = len(added), len(removed), len(updated)
+                if (summary.added, summary.removed, summary.updated) == \
+                        (len(plan.inserts), len(plan.deletes), len(plan.updates)):
+                    source.mark_synced()
+        except Exception as e:
+            logging.error(f'Sync job {job.name} failed', exc_info=e)
+            summary.error = e
+
+        summary.elapsed = time.perf_counter() - start
+        return summary